@@ -0,0 +1,3 @@
+# coding=utf-8
+
+__author__ = 'Gareth Coles'
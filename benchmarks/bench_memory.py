@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+Measures the memory used by DataManager for a synthetic graph of 100k channels and 10k server configs, along with
+the time taken by the lookups that relaying and the link commands make.
+
+The data is handed to the DataManager the same way a storage backend would at startup, with a separate string for
+every ID, as a YAML parser produces them.
+
+Run with `python -m benchmarks.bench_memory` from the repository root. RSS is read from `/proc/self/statm` where it's
+available, and falls back to the peak RSS reported by `resource` elsewhere.
+"""
+
+import gc
+import os
+import random
+import resource
+import timeit
+import tracemalloc
+
+from benchmarks.common import SyntheticStorage, random_ids
+from bot.data import DataManager
+
+__author__ = "Gareth Coles"
+
+CHANNELS = 100000
+SERVERS = 10000
+HUB_SPACING = 1000  # Every this-many channels is a hub, linked to a few hundred others
+HUB_LINKS = 250
+LOOKUPS = 100000
+
+
+def get_rss() -> int:
+    try:
+        with open("/proc/self/statm", "r") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    ids = random_ids(CHANNELS)
+
+    # Half of these pairs are linked and half aren't, and a fifth of them involve a hub
+    pairs, hub_pairs = [], []
+
+    for _ in range(LOOKUPS):
+        i = random.randrange(0, CHANNELS - 1, 2)
+
+        if random.random() < 0.2:
+            hub = i // HUB_SPACING * HUB_SPACING
+            pair = ids[hub], ids[hub + random.randint(1, HUB_LINKS) * 3 + random.randint(0, 1)]
+            hub_pairs.append((str(pair[0]), str(pair[1])))
+        else:
+            pair = ids[i], ids[i + 1] if random.random() < 0.5 else ids[(i + 3) % CHANNELS]
+
+        # Commands get channel IDs from discord.py, as strings
+        pairs.append((str(pair[0]), str(pair[1])))
+
+    origins = [str(random.choice(ids)) for _ in range(LOOKUPS)]
+    servers = [str(10 ** 17 + i) for i in range(SERVERS)]
+
+    storage = SyntheticStorage(
+        ids, hub_spacing=HUB_SPACING, hub_links=HUB_LINKS,
+        config={"control_chars": ";", "fire_and_forget": "no", "coalesce_window": "0"}
+    )
+    manager = DataManager(storage=storage, cache_size=SERVERS)
+
+    gc.collect()
+    before = get_rss()
+    tracemalloc.start()
+
+    manager.load()
+
+    for server_id in servers:
+        manager.get_server(server_id)
+
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    used = get_rss() - before
+
+    has_target = timeit.timeit(lambda: [manager.has_target(left, right) for left, right in pairs], number=1)
+    has_hub_target = timeit.timeit(lambda: [manager.has_target(left, right) for left, right in hub_pairs], number=1)
+    get_all_targets = timeit.timeit(lambda: [manager.get_all_targets(origin) for origin in origins], number=1)
+    is_grouped = timeit.timeit(lambda: [manager.is_grouped_channel("group-0", origin) for origin in origins], number=1)
+
+    print("{} channels, {} routes, {} servers".format(CHANNELS, len(manager.routes), SERVERS))
+    print("RSS growth after loading:  {:>8.1f} MiB".format(used / 1024 / 1024))
+    print("Memory still allocated:    {:>8.1f} MiB".format(allocated / 1024 / 1024))
+    print("has_target():              {:>8.3f} µs".format(has_target / LOOKUPS * 1000000))
+    print("has_target(), hubs only:   {:>8.3f} µs".format(has_hub_target / len(hub_pairs) * 1000000))
+    print("get_all_targets():         {:>8.3f} µs".format(get_all_targets / LOOKUPS * 1000000))
+    print("is_grouped_channel():      {:>8.3f} µs".format(is_grouped / LOOKUPS * 1000000))
+
+
+if __name__ == "__main__":
+    main()
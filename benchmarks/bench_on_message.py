@@ -0,0 +1,108 @@
+# coding=utf-8
+"""
+Measures the cost of `Client.on_message` with logging at INFO, for messages in channels with and without routes,
+alongside the per-message debug logging that it used to do regardless of the log level.
+
+Relaying itself is stubbed out, so this only covers the work done before a message is queued up to be relayed.
+
+Run with `python -m benchmarks.bench_on_message` from the repository root.
+"""
+
+import logging
+import timeit
+
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from benchmarks.common import SyntheticStorage
+from bot.client import Client
+from bot.data import DataManager
+
+__author__ = "Gareth Coles"
+
+CHANNELS = 10000
+SERVERS = 1000
+MESSAGES = 100000
+CONTENT = "Some fairly ordinary chat message\nthat goes on for\na few lines"
+
+
+def create_client() -> Client:
+    client = Client.__new__(Client)  # Skips reading config.yml and connecting to Discord
+
+    client.user = SimpleNamespace(id="1")
+    client.triggers = OrderedDict()
+    client.config = {"owner_id": "2"}
+
+    # Only the first half of the channels are routed anywhere
+    storage = SyntheticStorage(list(range(CHANNELS)), linked=CHANNELS // 2, extras=False, config={"control_chars": "!"})
+    client.data_manager = DataManager(storage=storage, cache_size=SERVERS)
+    client.data_manager.load()
+
+    client.ingress = SimpleNamespace(submit=lambda origin, message: True)
+    return client
+
+
+def create_messages(routed: bool):
+    messages = []
+    author = SimpleNamespace(id="3", name="Someone", discriminator="1234")
+
+    for i in range(MESSAGES):
+        channel_id = i % (CHANNELS // 2) + (0 if routed else CHANNELS // 2)
+        server_id = channel_id % SERVERS
+
+        messages.append(SimpleNamespace(
+            server=SimpleNamespace(id=str(server_id), name="Server {}".format(server_id)),
+            channel=SimpleNamespace(id=str(channel_id), name="channel-{}".format(channel_id)),
+            author=author, content=CONTENT
+        ))
+
+    return messages
+
+
+def legacy_trace(message):
+    # What `on_message` used to do for every message, before it knew whether there was anything to do
+    logger = logging.getLogger(message.server.name)
+
+    user = "{}#{}".format(
+        message.author.name, message.author.discriminator
+    )
+
+    for line in message.content.split("\n"):
+        logger.debug("#{} / {} {}".format(
+            message.channel.name,
+            user, line
+        ))
+
+
+def run(coroutine):
+    try:
+        coroutine.send(None)
+    except StopIteration:
+        pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+
+    client = create_client()
+
+    for routed in (True, False):
+        messages = create_messages(routed)
+
+        for message in messages[:SERVERS]:
+            run(client.on_message(message))  # Loads every server config before timing
+
+        taken = timeit.timeit(lambda: [run(client.on_message(message)) for message in messages], number=1)
+        print("on_message(), {:>8} channels: {:>8.3f} µs".format(
+            "routed" if routed else "unrouted", taken / MESSAGES * 1000000
+        ))
+
+    loggers = len(logging.Logger.manager.loggerDict)
+    taken = timeit.timeit(lambda: [legacy_trace(message) for message in messages], number=1)
+
+    print("Old per-message tracing alone:    {:>8.3f} µs".format(taken / MESSAGES * 1000000))
+    print("Loggers created by old tracing:   {:>8}".format(len(logging.Logger.manager.loggerDict) - loggers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# coding=utf-8
+"""
+Compares the CPU cost of building and encoding a relay payload per target against building it once per message.
+
+Run with `python -m benchmarks.bench_payload` from the repository root.
+"""
+
+import json
+import timeit
+
+from bot.delivery import Payload
+
+__author__ = "Gareth Coles"
+
+CONTENT = "Some fairly ordinary chat message, with a link: https://example.com/some/path?query=value " * 4
+EMBEDS = [{
+    "type": "rich",
+    "title": "An embed",
+    "description": "With a description that's a bit longer than the title is " * 5,
+    "fields": [{"name": "Field {}".format(i), "value": "Value {}".format(i), "inline": True} for i in range(10)]
+}]
+
+FAN_OUTS = [1, 5, 15, 50]
+ITERATIONS = 2000
+
+
+def per_target(targets):
+    # What `execute_webhook` used to do for every single target
+    for _ in range(targets):
+        payload = {
+            "content": CONTENT,
+            "username": "Someone",
+            "avatar_url": "https://cdn.discordapp.com/avatars/1/abc.png",
+            "tts": False,
+            "file": None,
+            "embeds": EMBEDS
+        }
+
+        for key, value in payload.copy().items():
+            if value is None:
+                del payload[key]
+
+        json.dumps(payload).encode("utf-8")
+
+
+def per_message(targets):
+    payload = Payload.create(
+        content=CONTENT, username="Someone", avatar_url="https://cdn.discordapp.com/avatars/1/abc.png",
+        embeds=EMBEDS
+    )
+
+    for _ in range(targets):
+        payload.body  # Encoded on first access only
+
+
+def main():
+    print("{:>8} | {:>14} | {:>14} | {:>8}".format("targets", "per-target", "per-message", "saving"))
+
+    for targets in FAN_OUTS:
+        before = timeit.timeit(lambda: per_target(targets), number=ITERATIONS) / ITERATIONS
+        after = timeit.timeit(lambda: per_message(targets), number=ITERATIONS) / ITERATIONS
+
+        print("{:>8} | {:>11.1f} µs | {:>11.1f} µs | {:>7.1f}x".format(
+            targets, before * 1e6, after * 1e6, before / after
+        ))
+
+
+if __name__ == "__main__":
+    main()
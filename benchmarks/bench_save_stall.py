@@ -0,0 +1,92 @@
+# coding=utf-8
+"""
+Measures how long the event loop is stalled while DataManager writes a large data set, comparing an inline flush
+(how every save used to work) against the executor-based background flush.
+
+Run with `python -m benchmarks.bench_save_stall` from the repository root. Data is written to a temporary directory.
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from bot.data import DataManager, SECTIONS
+
+__author__ = "Gareth Coles"
+
+CHANNELS = 20000
+SERVERS = 2000
+TICK = 0.001
+
+
+def populate(manager: DataManager):
+    random.seed(0)
+    ids = [str(random.randrange(10 ** 17, 10 ** 18)) for _ in range(CHANNELS)]
+
+    for i in range(0, CHANNELS - 1, 2):
+        manager.add_target(ids[i], ids[i + 1])
+
+    for i in range(0, CHANNELS, 4):
+        manager.add_relay(ids[i], ids[(i + 7) % CHANNELS])
+        manager.group_channel("group-{}".format(i % 500), ids[i])
+        manager.set_prefix(ids[i], ids[(i + 3) % CHANNELS], "p{}:".format(i % 50))
+
+    for i in range(SERVERS):
+        manager.add_server(str(10 ** 17 + i))
+
+
+def mark_everything(manager: DataManager):
+    manager.mark_dirty(*SECTIONS)
+    manager.dirty_servers.update(manager.data.keys())
+
+
+async def measure(loop, manager: DataManager, flush) -> float:
+    longest = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal longest
+        last = time.perf_counter()
+
+        while running:
+            await asyncio.sleep(TICK)
+            now = time.perf_counter()
+            longest = max(longest, now - last - TICK)
+            last = now
+
+    task = loop.create_task(ticker())
+    await asyncio.sleep(0.05)
+
+    mark_everything(manager)
+    await flush()
+
+    await asyncio.sleep(0.05)
+    running = False
+    await task
+
+    return longest
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    loop = asyncio.get_event_loop()
+
+    manager = DataManager(loop=loop, cache_size=SERVERS)
+    manager.load()
+    populate(manager)
+
+    async def inline():
+        manager.flush()
+
+    before = loop.run_until_complete(measure(loop, manager, inline))
+    after = loop.run_until_complete(measure(loop, manager, manager.flush_in_background))
+
+    print("{} channels, {} servers".format(CHANNELS, SERVERS))
+    print("Longest event loop stall, inline flush:     {:>8.1f} ms".format(before * 1000))
+    print("Longest event loop stall, background flush: {:>8.1f} ms".format(after * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# coding=utf-8
+"""
+Compares how long DataManager takes to save and load its routing data with the YAML and snapshot storage backends, at
+10k, 100k and 1M routes.
+
+Run with `python -m benchmarks.bench_snapshot` from the repository root. YAML is very slow at 1M routes, so it's
+skipped there unless `--all` is given. Data is written to a temporary directory.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.common import SyntheticStorage, random_ids
+from bot.data import DataManager
+from bot.storage import SECTIONS, SnapshotStorage, YAMLStorage
+
+__author__ = "Gareth Coles"
+
+SIZES = [10000, 100000, 1000000]
+YAML_LIMIT = 100000
+
+
+def measure(manager: DataManager, storage_class, directory):
+    os.mkdir(directory)
+
+    manager.storage = storage_class(directory)
+    manager.mark_dirty(*SECTIONS)
+
+    started = time.perf_counter()
+    manager.flush()
+    save = time.perf_counter() - started
+
+    loaded = DataManager(storage=storage_class(directory))
+
+    started = time.perf_counter()
+    loaded.load()
+    load = time.perf_counter() - started
+
+    assert loaded.routes == manager.routes
+
+    return save, load
+
+
+def main():
+    base_dir = tempfile.mkdtemp()
+
+    print("{:>8} | {:>10} | {:>10} | {:>13} | {:>13}".format(
+        "routes", "YAML save", "YAML load", "snapshot save", "snapshot load"
+    ))
+
+    try:
+        for routes in SIZES:
+            manager = DataManager(storage=SyntheticStorage(random_ids(routes), webhooks=True))
+            manager.load()
+
+            snapshot_save, snapshot_load = measure(
+                manager, SnapshotStorage, os.path.join(base_dir, "snapshot-{}".format(routes))
+            )
+
+            if routes <= YAML_LIMIT or "--all" in sys.argv:
+                yaml_save, yaml_load = measure(manager, YAMLStorage, os.path.join(base_dir, "yaml-{}".format(routes)))
+                yaml_save, yaml_load = "{:.2f}s".format(yaml_save), "{:.2f}s".format(yaml_load)
+            else:
+                yaml_save = yaml_load = "skipped"
+
+            print("{:>8} | {:>10} | {:>10} | {:>12.2f}s | {:>12.2f}s".format(
+                len(manager.routes), yaml_save, yaml_load, snapshot_save, snapshot_load
+            ))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    main()
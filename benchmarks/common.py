@@ -0,0 +1,67 @@
+# coding=utf-8
+import random
+
+from bot.storage import Storage
+
+__author__ = "Gareth Coles"
+
+
+def random_ids(count, seed=0) -> list:
+    random.seed(seed)
+    return [random.randrange(10 ** 17, 10 ** 18) for _ in range(count)]
+
+
+class SyntheticStorage(Storage):
+    # Hands a synthetic graph to the DataManager the same way a storage backend would at startup, with a separate
+    # string for every ID, as a YAML parser produces them
+
+    def __init__(self, ids, linked=None, hub_spacing=0, hub_links=0, extras=True, webhooks=False, config=None):
+        self.ids = ids
+        self.linked = len(ids) if linked is None else linked  # Only this many of the IDs are linked to anything
+
+        self.hub_spacing = hub_spacing  # Every this-many channels is a hub, linked to `hub_links` others
+        self.hub_links = hub_links
+
+        self.extras = extras  # Whether to add relays, groups and prefixes as well
+        self.webhooks = webhooks
+        self.config = config or {}
+
+    def load(self):
+        ids = self.ids
+        count = len(ids)
+        links, relays, groups, prefixes, webhooks = {}, {}, {}, {}, {}
+
+        def link(left, right):
+            # Formatting creates a fresh string every time, like parsing a YAML file does
+            links.setdefault("{}".format(left), []).append("{}".format(right))
+            links.setdefault("{}".format(right), []).append("{}".format(left))
+
+        for i in range(0, self.linked - 1, 2):
+            link(ids[i], ids[i + 1])
+
+        if self.hub_spacing:
+            for hub in range(0, count, self.hub_spacing):
+                for i in range(1, self.hub_links + 1):
+                    link(ids[hub], ids[hub + i * 3])
+
+        if self.extras:
+            for i in range(0, count, 4):
+                relays["{}".format(ids[i])] = ["{}".format(ids[(i + 7) % count])]
+
+            for i in range(0, count, 10):
+                groups.setdefault("group-{}".format(i // 100), []).append("{}".format(ids[i]))
+
+            for i in range(0, count, 20):
+                prefixes["{}".format(ids[i])] = {"p{}:".format(i % 50): "{}".format(ids[(i + 3) % count])}
+
+        if self.webhooks:
+            for i in range(count):
+                webhooks["{}".format(ids[i])] = {"id": str(10 ** 17 + i), "token": "x" * 68}
+
+        return {"channels": links, "relays": relays, "groups": groups, "prefixes": prefixes, "webhooks": webhooks}
+
+    def load_server(self, server_id):
+        return dict(self.config)
+
+    def has_server(self, server_id):
+        return True
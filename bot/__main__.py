@@ -1,14 +1,108 @@
 # coding=utf-8
+import asyncio
+import os
 import sys
 import logging
 
+from ruamel import yaml
+
 from bot.client import Client
+from bot.data import DataManager
+from bot.export import read_export
 from bot.log_handler import DiscordLogHandler
+from bot.storage import get_storage
 
 __author__ = "Gareth Coles"
 
+SHARED_STORAGE_OPTIONS = ("base_dir", "server_shards")  # Options that every backend takes, and that mean the same thing
+
+
+def convert(source, target):
+    logging.basicConfig(format="%(asctime)s | %(name)10s | %(levelname)8s | %(message)s", level=logging.INFO)
+
+    # Loaded through a DataManager, so that anything still in the source's journal is included
+    manager = DataManager(storage=get_storage(source, **get_storage_options(source)))
+    manager.load()
+
+    target_storage = get_storage(target, **get_storage_options(target))
+
+    manager.migrate(target_storage)
+    manager.storage.close()
+    target_storage.close()
+
+    logging.getLogger("Storage").info("Converted stored data from {} to {}".format(source, target))
+
+
+def get_storage_config():
+    config = {}
+
+    if os.path.exists("config.yml"):
+        with open("config.yml", "r") as fh:
+            config = yaml.safe_load(fh) or {}
+
+    return config.get("storage", "yaml"), config.get("storage_options") or {}
+
+
+def get_storage_options(name) -> dict:
+    configured, options = get_storage_config()
+
+    if name == configured:
+        return options
+
+    # The rest are specific to the configured backend
+    return {key: value for key, value in options.items() if key in SHARED_STORAGE_OPTIONS}
+
+
+def get_configured_storage():
+    name, options = get_storage_config()
+    return get_storage(name, **options)
+
+
+def export_data(path):
+    logging.basicConfig(format="%(asctime)s | %(name)10s | %(levelname)8s | %(message)s", level=logging.INFO)
+
+    # Loaded through a DataManager, so that anything still in the journal is included
+    manager = DataManager(storage=get_configured_storage())
+    manager.load()
+
+    count = asyncio.get_event_loop().run_until_complete(manager.export(path))
+    manager.storage.close()
+
+    logging.getLogger("Storage").info("Exported {} records to {}".format(count, path))
+
+
+def import_data(path):
+    logging.basicConfig(format="%(asctime)s | %(name)10s | %(levelname)8s | %(message)s", level=logging.INFO)
+
+    sections, servers = read_export(path)
+    DataManager.convert_sections(dict(sections))  # Makes sure that it can all be loaded again before storing it
+
+    storage = get_configured_storage()
+
+    storage.replace_all(sections, servers)
+    storage.close()
+
+    logging.getLogger("Storage").info("Imported {} records from {}".format(
+        sum(len(data) for data in sections.values()) + len(servers), path
+    ))
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "convert":
+        if len(sys.argv) < 4:
+            return print("Usage: python -m bot convert <from> <to>", file=sys.stderr)
+
+        return convert(sys.argv[2], sys.argv[3])
+
+    if len(sys.argv) > 1 and sys.argv[1] in ("export", "import"):
+        if len(sys.argv) < 3:
+            return print("Usage: python -m bot {} <file>".format(sys.argv[1]), file=sys.stderr)
+
+        if sys.argv[1] == "export":
+            return export_data(sys.argv[2])
+
+        return import_data(sys.argv[2])
+
     client = Client()
 
     file_handler = logging.FileHandler(
@@ -1,12 +1,16 @@
 # coding=utf-8
 import datetime
+import functools
 import io
 import logging
+import os
 import re
 import shlex
+import time
 import traceback
 
 import asyncio
+from collections import deque, OrderedDict
 from typing import Dict, List
 
 import discord
@@ -16,11 +20,18 @@ from discord import Embed, Colour, Channel, Server
 from discord.http import Route
 from ruamel import yaml
 
-from bot.data import DataManager
+from bot.commands import (
+    PERMISSION_MANAGE_SERVER, PERMISSION_OWNER, build_commands, command, compile_trigger, parse_command
+)
+from bot.data import DataManager, FLAG_KEYS, INTEGER_KEYS
+from bot.delivery import DeliveryScheduler, MAX_COALESCE_DELAY, Payload, is_stale_webhook_error
+from bot.ingress import IngressQueue
 from bot.interpreter import Interpreter
-from bot.utils import line_splitter
+from bot.storage import get_storage
+from bot.utils import line_splitter, parse_flag
 
 log = logging.getLogger("bot")
+message_log = logging.getLogger("Messages")  # Records carry `server_id` and `server_name`, for filtering by server
 
 __author__ = 'Gareth Coles'
 
@@ -33,8 +44,15 @@ LOG_COLOURS = {
 
 CONFIG_KEY_DESCRIPTIONS = {
     "control_chars": "Characters that all commands must be prefixed with. You can always mention me as well instead.",
+    "fire_and_forget": "Set to `yes` to relay messages without waiting for Discord to confirm each one. This is faster "
+                       "on busy channels, but delivery errors will only be reported after the fact.",
+    "coalesce_window": "Time in milliseconds to wait for more messages from the same user before relaying them. "
+                       "Consecutive messages within this window are relayed together as one, where they fit. "
+                       "Set to `0` to disable. At most 2000, as a burst may be held back for five times this long.",
 }
 
+MAX_COALESCE_WINDOW = 2000  # Milliseconds
+
 WELCOME_MESSAGE = [
     """
 Hello! I was invited to this server to relay messages between channels.
@@ -59,24 +77,42 @@ To read up on how to use me, you should really take a look at our documentation
 
 
 class Client(discord.client.Client):
-    normal_mention = None
-    nick_mention = None
-
     def __init__(self, *, loop=None, **options):
         super().__init__(loop=loop, **options)
 
         self.banned_ids = []
-        self.webhooks = {}  # {channel_id: webhook_url}
+        self.pending_hooks = {}  # {channel_id: Task}
+        self.warm_up_task = None
+        self.reload_task = None
 
         with open("config.yml", "r") as fh:
             self.config = yaml.safe_load(fh)
 
-        self.data_manager = DataManager()
+        self.commands = build_commands(self)  # {name: Command}
+        self.triggers = OrderedDict()  # {server_id: compiled regex} - see `get_trigger()`
+        self.delivery = DeliveryScheduler(self, concurrency=self.config.get("relay_concurrency", 10))
+
+        # Messages are relayed by a fixed pool of workers, rather than in the task discord.py runs `on_message` in
+        self.ingress = IngressQueue(
+            self.do_relay, self.loop, size=self.config.get("relay_queue_size", 1000),
+            workers=self.config.get("relay_workers", 10), policy=self.config.get("relay_overflow_policy", "fair"),
+            max_pending=self.config.get("relay_max_pending", 5000)
+        )
+
+        self.data_manager = DataManager(
+            loop=self.loop, save_delay=self.config.get("save_delay", 5),
+            cache_size=self.config.get("server_cache_size", 1000),
+            storage=get_storage(self.config.get("storage", "yaml"), **self.config.get("storage_options", {}))
+        )
         self.interpreter = Interpreter(locals(), self)
 
     def get_token(self):
         return self.config["token"]
 
+    def get_channel(self, channel_id):
+        # We store channel IDs as ints, but discord.py keys its channels by string
+        return super().get_channel(str(channel_id))
+
     def get_channel_info(self, channel):
         return "`#{}` on `{}`".format(channel.name, channel.server.name)
 
@@ -93,7 +129,7 @@ class Client(discord.client.Client):
             record.created
         )
 
-        description = record.msg
+        description = record.getMessage()
 
         if record.exc_info:
             description += "\n\n```{}```".format("\n".join(traceback.format_exception(*record.exc_info)))
@@ -115,7 +151,22 @@ class Client(discord.client.Client):
 
     async def close(self):
         log.info("Shutting down...")
-        self.data_manager.save()
+
+        # Everything that might still change our data has to be stopped before the last flush, or its changes would
+        # be lost (or recorded to storage that's already been closed)
+        tasks = self.ingress.close()
+        tasks.extend(task for task in (self.warm_up_task, self.reload_task) if task is not None and not task.done())
+        tasks.extend(self.pending_hooks.values())
+
+        for task in tasks:
+            task.cancel()
+
+        self.delivery.close()
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        await self.data_manager.close()
         await discord.client.Client.close(self)
 
     def channels_updated(self, server):
@@ -123,49 +174,47 @@ class Client(discord.client.Client):
 
     async def on_ready(self):
         log.info("Setting up...")
-        self.data_manager.load()
 
-        self.normal_mention = "<@{}>".format(self.user.id)
-        self.nick_mention = "<@!{}>".format(self.user.id)
+        # This runs again after every reconnect, and reloading then would throw away any changes that haven't been
+        # written yet - so we only load once
+        if not self.data_manager.loaded:
+            self.data_manager.load()
 
-        for server in self.servers:
-            self.data_manager.add_server(server.id)
+        # Server configs are loaded (or created) the first time they're needed, rather than all up-front
+        log.info("Ready!")
 
-        log.debug("Getting webhooks...")
-        for channel_id, targets in list(self.data_manager.channels.items()):
-            hooks = 0
+        # Relaying works without this, but the first message to each channel would have to fetch its webhook first
+        if self.warm_up_task is None or self.warm_up_task.done():
+            self.warm_up_task = self.loop.create_task(self.warm_up_webhooks())
 
-            if channel_id not in self.webhooks:
-                try:
-                    h = await self.ensure_relay_hook(channel_id)
-                except Exception:
-                    log.exception("Unable to get webhook for channel: `{}`".format(channel_id))
-                    self.data_manager.remove_targets(channel_id)
-                    self.data_manager.save()
-                    continue
-
-                if h is None:  # Doesn't exist
-                    log.debug("Channel {} no longer exists.".format(channel_id))
-                    self.data_manager.remove_targets(channel_id)
-                    self.data_manager.save()
-                    continue
-                elif h is False:  # No permission
-                    await self.send_message(
-                        self.get_channel(channel_id),
-                        "**Error**: I do not have permission to manage webhooks on this channel.\n\n"
-                        "As I require this permission to function, I have entirely unlinked this channel. Please link "
-                        "it again when this is fixed."
-                    )
-                    self.data_manager.remove_targets(channel_id)
-                    self.data_manager.save()
-                    continue
-                else:
-                    self.webhooks[channel_id] = h
-                    hooks += 1
+        if self.config.get("reload_interval") and (self.reload_task is None or self.reload_task.done()):
+            if self.data_manager.storage.watchable:
+                self.reload_task = self.loop.create_task(self.watch_data())
+            else:
+                log.warning("The `{}` storage backend doesn't support reloading changed data".format(
+                    self.data_manager.storage.name
+                ))
 
-            log.debug("Got {} webhooks for channel `{}`".format(hooks, channel_id))
+    async def watch_data(self):
+        interval = self.config["reload_interval"]
 
-        log.info("Ready!")
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                changed = await self.data_manager.reload_changed()
+            except Exception:
+                log.exception("Unable to reload changed data")
+                continue
+
+            if not changed:
+                continue
+
+            log.info("Reloaded changed data: {}".format(", ".join(sorted(changed))))
+
+            # Any newly-linked channels will need their webhooks
+            if self.warm_up_task is None or self.warm_up_task.done():
+                self.warm_up_task = self.loop.create_task(self.warm_up_webhooks())
 
     async def on_server_join(self, server):
         self.data_manager.add_server(server.id)
@@ -183,55 +232,78 @@ class Client(discord.client.Client):
         if str(message.author.discriminator) == "0000":
             return
 
-        logger = logging.getLogger(message.server.name)
+        content = message.content
+        parsed = parse_command(self.get_trigger(message.server), content)
 
-        user = "{}#{}".format(
-            message.author.name, message.author.discriminator
-        )
+        if parsed is None and int(message.channel.id) not in self.data_manager.routed_channels:
+            return  # Most messages are in channels with nowhere to relay to, where only commands need any more work
 
-        for line in message.content.split("\n"):
-            logger.debug("#{} / {} {}".format(
-                message.channel.name,
-                user, line
-            ))
+        if message_log.isEnabledFor(logging.DEBUG):
+            extra = {"server_id": message.server.id, "server_name": message.server.name}
 
-        chars = self.data_manager.get_server_command_chars(message.server)
-        text = None
+            for line in content.split("\n"):
+                message_log.debug(
+                    "%s #%s / %s#%s %s", message.server.name, message.channel.name,
+                    message.author.name, message.author.discriminator, line, extra=extra
+                )
 
-        if message.content.startswith(chars):  # It's a command
-            text = message.content[len(chars):].strip()
-        elif message.content.startswith(self.normal_mention):
-            text = message.content[len(self.normal_mention):].strip()
-        elif message.content.startswith(self.nick_mention):
-            text = message.content[len(self.nick_mention):].strip()
+        if parsed:  # It's a command
+            name, args_string = parsed
+            cmd = self.commands.get(name)
 
-        if text:
-            if " " in text:
-                command, args = text.split(" ", 1)
-            else:
-                command = text
-                args = ""
+            if cmd is None:
+                return log.debug("Unknown command: %r", name)
 
-            args_string = args
-            args = shlex.split(args)
+            if cmd.permission == PERMISSION_OWNER and int(message.author.id) != int(self.config["owner_id"]):
+                return log.debug("Permission denied")
 
-            if len(args) > 0:
-                data = args[0:]
-            else:
+            if cmd.permission == PERMISSION_MANAGE_SERVER and not self.has_permission(message.author):
+                return log.debug("Permission denied")  # No perms
+
+            if cmd.raw_args:
                 data = []
+            else:
+                try:
+                    data = shlex.split(args_string)
+                except ValueError as e:  # Usually unbalanced quotes
+                    return await self.send_message(
+                        message.channel, "{} Unable to parse arguments: {}".format(message.author.mention, e)
+                    )
 
-            log.debug("Command: {}".format(repr(command)))
-            log.debug("Args: {}".format(repr(args)))
-            log.debug("Args string: {}".format(repr(args_string)))
-            log.debug("Data: {}".format(repr(data)))
+            log.debug("Command: %r", cmd.name)
+            log.debug("Args string: %r", args_string)
+            log.debug("Data: %r", data)
 
-            if hasattr(self, "command_{}".format(command.replace("-", "_"))):
-                try:
-                    await getattr(self, "command_{}".format(command.replace("-", "_")))(data, args_string, message)
-                except Exception:
-                    log.exception("Error running command: {}".format(command))
+            try:
+                await cmd.handler(data, args_string, message)
+            except Exception:
+                log.exception("Error running command: {}".format(cmd.name))
         else:  # We should relay this
-            await self.do_relay(message)
+            self.ingress.submit(int(message.channel.id), message)
+
+    def get_trigger(self, server):
+        # Cached - call `forget_triggers()` whenever a server's control_chars changes
+        trigger = self.triggers.get(server.id)
+
+        if trigger is not None:
+            self.triggers.move_to_end(server.id)
+            return trigger
+
+        trigger = compile_trigger(self.data_manager.get_server_command_chars(server), self.user.id)
+        self.triggers[server.id] = trigger
+
+        # Kept to the same size as the server config cache, since that's what a miss would have to load from anyway
+        while len(self.triggers) > self.data_manager.cache_size:
+            self.triggers.popitem(last=False)
+
+        return trigger
+
+    def forget_triggers(self, *server_ids):
+        if not server_ids:
+            return self.triggers.clear()
+
+        for server_id in server_ids:
+            self.triggers.pop(server_id, None)
 
     def has_permission(self, user):
         if user.server_permissions.manage_server:
@@ -243,34 +315,116 @@ class Client(discord.client.Client):
 
     async def do_relay(self, message):
         targets = self.data_manager.get_all_targets(message.channel)
-        prefixed = self.data_manager.get_prefixes(message.channel)
-
         content = message.content
-        lower_content = content.lower()
 
-        for prefix, target in prefixed.items():
-            if lower_content.startswith(prefix):
-                targets.add(target)
-                content = content[len(prefix):]
-                break
+        match = self.data_manager.match_prefix(message.channel, content)
 
-        del lower_content
+        if match:  # Longest matching prefix wins
+            prefix, target = match
+            targets = targets | {target}
+            content = content[len(prefix):]
 
-        avatar = message.author.avatar_url
+        origin = int(message.channel.id)
+        targets = [channel_id for channel_id in targets if channel_id != origin]
+
+        if not targets:
+            return
+
+        # Payloads are built and encoded once here, and then shared between all of the targets
+        payloads = self.build_relay_payloads(message, content)
+
+        if not payloads:
+            return
+
+        # Read once per message, as looking up the server's config may mean loading it from storage
+        config = self.data_manager.get_config(message.server)
+        wait = not parse_flag(config["fire_and_forget"])
+        window = min(int(config["coalesce_window"]), self.get_max_coalesce_window()) / 1000
 
         for channel_id in targets:
-            if channel_id == message.channel.id:
-                continue
+            hook = self.data_manager.get_webhook(channel_id)
 
-            hook = self.webhooks.get(channel_id, None)
+            # Deliveries to cached webhooks are queued right away, so they keep the order that messages came in.
+            # Everything that has to wait on Discord happens in its own task, so that one slow or broken webhook
+            # can't hold up the rest, or the worker that's running this
+            if hook is not None:
+                deliveries = self.submit_relay(message, hook, payloads, wait, window)
+            else:
+                deliveries = None
 
-            if hook is None:
-                h = await self.ensure_relay_hook(channel_id)
+            task = self.loop.create_task(self.relay_to_target(message, channel_id, payloads, wait, window, deliveries))
+            task.add_done_callback(functools.partial(self.relay_finished, channel_id))
+
+            self.ingress.track(task)
+
+    def get_max_coalesce_window(self) -> int:
+        # A burst may be held back for `MAX_COALESCE_DELAY` windows, which has to fit well within `relay_timeout`
+        timeout = self.config.get("relay_timeout", 30) * 1000
+        return min(MAX_COALESCE_WINDOW, int(timeout / MAX_COALESCE_DELAY / 2))
+
+    def relay_finished(self, channel_id, task: asyncio.Future):
+        if task.cancelled():
+            return
 
-                if h:
-                    self.webhooks[channel_id] = h
+        e = task.exception()
 
-                hook = self.webhooks.get(channel_id, None)
+        if isinstance(e, asyncio.TimeoutError):
+            log.warning("Timed out relaying message to channel `{}`".format(channel_id))
+        elif e is not None:
+            log.error(
+                "Error relaying message to channel `{}`".format(channel_id),
+                exc_info=(type(e), e, e.__traceback__)
+            )
+
+    def build_relay_payloads(self, message, content) -> List[Payload]:
+        avatar = message.author.avatar_url
+        payloads = []
+
+        if content:
+            payloads.append(Payload.create(
+                content=content, username=message.author.display_name,
+                avatar_url=avatar if avatar else None,
+                embeds=message.embeds
+            ))
+        elif message.embeds:
+            payloads.append(Payload.create(
+                username=message.author.display_name,
+                avatar_url=avatar if avatar else None,
+                embeds=message.embeds
+            ))
+
+        if message.attachments:
+            lines = ["__**Attachments**__\n"]
+
+            for attachment in message.attachments:
+                lines.append("**{}**: {}".format(attachment["filename"], attachment["url"]))
+
+            for split_line in line_splitter(lines, 2000):
+                payloads.append(Payload.create(
+                    content=split_line, username=message.author.display_name,
+                    avatar_url=avatar if avatar else None
+                ))
+
+        return payloads
+
+    async def relay_to_target(self, message, channel_id, payloads, wait, window, deliveries=None):
+        timeout = self.config.get("relay_timeout", 30)
+
+        await asyncio.wait_for(
+            self.do_relay_to_target(message, channel_id, payloads, wait, window, deliveries=deliveries), timeout
+        )
+
+    def submit_relay(self, message, hook, payloads, wait, window) -> List[asyncio.Future]:
+        return [
+            self.delivery.submit(
+                hook["id"], hook["token"], payload, wait=wait,
+                coalesce_key=message.author.id, coalesce_window=window
+            ) for payload in payloads
+        ]
+
+    async def do_relay_to_target(self, message, channel_id, payloads, wait, window, retry=True, deliveries=None):
+        if deliveries is None:
+            hook = await self.get_relay_hook(channel_id)
 
             if hook is None:
                 await self.send_message(
@@ -280,50 +434,74 @@ class Client(discord.client.Client):
                 )
                 self.data_manager.unlink_all(channel_id)
                 self.data_manager.save()
-            else:
-                try:
-                    if content:
-                        await self.execute_webhook(
-                            hook["id"], hook["token"], wait=True,
-                            content=content, username=message.author.display_name,
-                            avatar_url=avatar if avatar else None,
-                            embeds=message.embeds
-                        )
-                    elif message.embeds:
-                        await self.execute_webhook(
-                            hook["id"], hook["token"], wait=True,
-                            username=message.author.display_name,
-                            avatar_url=avatar if avatar else None,
-                            embeds=message.embeds
-                        )
+                return
 
-                    if message.attachments:
-                        lines = ["__**Attachments**__\n"]
+            deliveries = self.submit_relay(message, hook, payloads, wait, window)
 
-                        for attachment in message.attachments:
-                            lines.append("**{}**: {}".format(attachment["filename"], attachment["url"]))
+        if not deliveries:
+            return
 
-                        for split_line in line_splitter(lines, 2000):
-                            await self.execute_webhook(
-                                hook["id"], hook["token"], wait=True,
-                                content=split_line, username=message.author.display_name,
-                                avatar_url=avatar if avatar else None
-                            )
-                except Exception as e:
-                    await self.send_message(
-                        message.channel,
-                        "Error executing webhook for channel `{}` - unlinking channel\n\n```{}```".format(channel_id, e)
-                    )
-                    self.data_manager.remove_targets(channel_id)
-                    self.data_manager.save()
-                    raise
+        # Deliveries to the same webhook share a queue, so they'll still be sent in order
+        result = asyncio.gather(*deliveries)
+
+        if not wait:  # Fire-and-forget; any errors are dealt with whenever they turn up
+            self.ingress.track(result)
+            result.add_done_callback(
+                functools.partial(self.relay_delivered, message, channel_id, payloads, window, retry)
+            )
+            return
+
+        try:
+            await result
+        except asyncio.CancelledError:
+            for future in deliveries:
+                future.cancel()
+
+            raise
+        except Exception as e:
+            if retry and is_stale_webhook_error(e):
+                log.info("Cached webhook for channel `{}` is no longer valid, fetching it again".format(channel_id))
+                self.data_manager.remove_webhook(channel_id)
+
+                return await self.do_relay_to_target(message, channel_id, payloads, wait, window, retry=False)
+
+            await self.relay_failed(message, channel_id, e)
+            raise
+
+    def relay_delivered(self, message, channel_id, payloads, window, retry, result: asyncio.Future):
+        if result.cancelled() or result.exception() is None:
+            return
+
+        e = result.exception()
+
+        if retry and is_stale_webhook_error(e):
+            log.info("Cached webhook for channel `{}` is no longer valid, fetching it again".format(channel_id))
+            self.data_manager.remove_webhook(channel_id)
+
+            self.ingress.track(self.loop.create_task(
+                self.do_relay_to_target(message, channel_id, payloads, False, window, retry=False)
+            ))
+            return
+
+        log.error(
+            "Error relaying message to channel `{}`".format(channel_id),
+            exc_info=(type(e), e, e.__traceback__)
+        )
+
+        self.loop.create_task(self.relay_failed(message, channel_id, e))
+
+    async def relay_failed(self, message, channel_id, e):
+        await self.send_message(
+            message.channel,
+            "Error executing webhook for channel `{}` - unlinking channel\n\n```{}```".format(channel_id, e)
+        )
+        self.data_manager.remove_targets(channel_id)
+        self.data_manager.save()
 
     # region Commands
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_config(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             config = self.data_manager.get_config(message.server)
 
@@ -359,19 +537,44 @@ class Client(discord.client.Client):
                     message.channel, "{} Unknown key: `{}`".format(message.author.mention, key)
                 )
 
+            if key in FLAG_KEYS:
+                try:
+                    parse_flag(value)
+                except ValueError:
+                    return await self.send_message(
+                        message.channel, "{} **{}** must be either `yes` or `no`".format(message.author.mention, key)
+                    )
+
+            if key in INTEGER_KEYS:
+                try:
+                    if int(value) < 0:
+                        raise ValueError()
+                except ValueError:
+                    return await self.send_message(
+                        message.channel, "{} **{}** must be a whole number".format(message.author.mention, key)
+                    )
+
+            if key == "coalesce_window" and int(value) > self.get_max_coalesce_window():
+                return await self.send_message(
+                    message.channel, "{} **{}** can be at most `{}`".format(
+                        message.author.mention, key, self.get_max_coalesce_window()
+                    )
+                )
+
             self.data_manager.set_config(message.server, key, value)
             self.data_manager.save_server(message.server.id)
 
+            if key == "control_chars":
+                self.forget_triggers(message.server.id)
+
             await self.send_message(
                 message.channel, "{} **{}** is now set to `{}`".format(
                     message.author.mention, key, value
                 )
             )
 
+    @command(permission=PERMISSION_OWNER, raw_args=True)
     async def command_eval(self, data, data_string, message):
-        if int(message.author.id) != int(self.config["owner_id"]):
-            return
-
         code = data_string.strip(" ")
 
         if code.startswith("```") and code.endswith("```"):
@@ -416,13 +619,54 @@ class Client(discord.client.Client):
                 message.channel, out_message
             )
 
+    @command(permission=PERMISSION_OWNER)
+    async def command_export(self, data, data_string, message):
+        if data:
+            path = data[0]
+        else:
+            if not os.path.exists("exports"):
+                os.mkdir("exports")
+
+            path = os.path.join("exports", "export-{}.jsonl.gz".format(
+                datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+            ))
+
+        await self.send_typing(message.channel)
+
+        try:
+            count = await self.data_manager.export(path)
+        except Exception as e:
+            log.exception("Unable to export data to {}".format(path))
+            return await self.send_message(message.channel, "Unable to export data: `{}`".format(e))
+
+        await self.send_message(message.channel, "Exported {} records to `{}`".format(count, path))
+
+    @command(permission=PERMISSION_OWNER)
+    async def command_import(self, data, data_string, message):
+        if len(data) < 1:
+            return await self.send_message(message.channel, "Usage: `import <path>`")
+
+        await self.send_typing(message.channel)
+
+        try:
+            count = await self.data_manager.import_file(data[0])
+        except Exception as e:
+            log.exception("Unable to import data from {}".format(data[0]))
+            return await self.send_message(message.channel, "Unable to import data: `{}`".format(e))
+
+        self.forget_triggers()  # Server configs have been replaced too
+
+        # Any newly-linked channels will need their webhooks
+        if self.warm_up_task is None or self.warm_up_task.done():
+            self.warm_up_task = self.loop.create_task(self.warm_up_webhooks())
+
+        await self.send_message(message.channel, "Imported {} records from `{}`".format(count, data[0]))
+
     async def command_help(self, data, data_string, message):
         await self.send_message(message.channel, "{} {}".format(message.author.mention, HELP_MESSAGE))
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_link(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `link <channel ID> [channel ID]`")
 
@@ -478,7 +722,7 @@ class Client(discord.client.Client):
                         "Unable to set up webhook for {}: I don't have the Manage Webhooks "
                         "permission.".format(self.get_channel_info(left))
                     )
-                self.webhooks[left.id] = h
+                self.data_manager.set_webhook(left.id, h)
             except Exception as e:
                 await self.send_message(
                     message.channel,
@@ -497,7 +741,7 @@ class Client(discord.client.Client):
                         "permission.".format(self.get_channel_info(right))
                     )
 
-                self.webhooks[right.id] = h
+                self.data_manager.set_webhook(right.id, h)
             except Exception as e:
                 return await self.send_message(
                     message.channel,
@@ -530,10 +774,8 @@ class Client(discord.client.Client):
                 "Permission denied - you must have `Manage Server` on the server belonging to both channels"
             )
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_relay(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `relay <origin[|target]> [target]`")
 
@@ -590,7 +832,7 @@ class Client(discord.client.Client):
                         "permission.".format(self.get_channel_info(right))
                     )
 
-                self.webhooks[right.id] = h
+                self.data_manager.set_webhook(right.id, h)
             except Exception as e:
                 return await self.send_message(
                     message.channel,
@@ -623,10 +865,8 @@ class Client(discord.client.Client):
                 "Permission denied - you must have `Manage Server` on the server belonging to both channels"
             )
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_unrelay(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `unrelay <origin[|target]> [target]`")
 
@@ -697,10 +937,8 @@ class Client(discord.client.Client):
                 "channels."
             )
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_group(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `group <group> [channel ID]`")
 
@@ -762,7 +1000,7 @@ class Client(discord.client.Client):
                     "permission.".format(self.get_channel_info(channel))
                 )
 
-            self.webhooks[channel.id] = h
+            self.data_manager.set_webhook(channel.id, h)
         except Exception as e:
             return await self.send_message(
                 message.channel,
@@ -785,7 +1023,7 @@ class Client(discord.client.Client):
             )
 
         for grouped_channel in self.data_manager.get_channels_for_group(group):
-            if grouped_channel == message.channel.id:
+            if grouped_channel == int(message.channel.id):
                 continue
 
             c = self.get_channel(grouped_channel)
@@ -800,10 +1038,8 @@ class Client(discord.client.Client):
                 )
             )
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_ungroup(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `ungroup <group> [channel ID]`")
 
@@ -855,7 +1091,7 @@ class Client(discord.client.Client):
             )
 
         for grouped_channel in self.data_manager.get_channels_for_group(group):
-            if grouped_channel == message.channel.id:
+            if grouped_channel == int(message.channel.id):
                 continue
 
             c = self.get_channel(grouped_channel)
@@ -870,10 +1106,8 @@ class Client(discord.client.Client):
                 )
             )
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_prefix(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 2:
             return await self.send_message(message.channel, "Usage: `prefix <origin[|target]> <prefix> [target]`")
 
@@ -930,7 +1164,7 @@ class Client(discord.client.Client):
                         "permission.".format(self.get_channel_info(right))
                     )
 
-                self.webhooks[right.id] = h
+                self.data_manager.set_webhook(right.id, h)
             except Exception as e:
                 return await self.send_message(
                     message.channel,
@@ -963,10 +1197,8 @@ class Client(discord.client.Client):
                 "Permission denied - you must have `Manage Server` on the server belonging to both channels"
             )
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_unprefix(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `unrelay <origin[|prefix]> [prefix]`")
 
@@ -1080,7 +1312,7 @@ class Client(discord.client.Client):
                     lines.append("_Group: `{}`_".format(group))
 
                     for target in channels:
-                        if target == message.channel.id:
+                        if target == int(message.channel.id):
                             continue
 
                         channel = self.get_channel(target)
@@ -1110,10 +1342,8 @@ class Client(discord.client.Client):
         for line in line_splitter(lines, 2000):
             await self.send_message(message.channel, line)
 
+    @command(permission=PERMISSION_MANAGE_SERVER)
     async def command_unlink(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
-
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `unlink <channel ID> [channel ID]`")
 
@@ -1188,10 +1418,41 @@ class Client(discord.client.Client):
                 "channels."
             )
 
-    async def command_unlink_all(self, data, data_string, message):
-        if not self.has_permission(message.author):
-            return log.debug("Permission denied")  # No perms
+    @command(permission=PERMISSION_OWNER)
+    async def command_stats(self, data, data_string, message):
+        depths = self.delivery.depths()
+
+        lines = [
+            "__**Delivery queues**__\n",
+            "**Active webhook queues**: {}".format(len(self.delivery.queues)),
+            "**Queued deliveries**: {}".format(sum(depths.values()))
+        ]
+
+        if depths:
+            lines.append("")
+            lines.append("**Busiest webhooks**")
+
+            for webhook_id, depth in sorted(depths.items(), key=lambda x: x[1], reverse=True)[:10]:
+                lines.append("• `{}`: {}".format(webhook_id, depth))
+
+        lines.append("")
+        lines.append("__**Relay queue**__\n")
+        lines.append("**Overflow policy**: `{}`".format(self.ingress.policy))
+        lines.append("**Queued messages**: {}/{}".format(self.ingress.queued, self.ingress.size))
+        lines.append("**Messages being routed**: {}/{}".format(self.ingress.active, self.ingress.worker_count))
+        lines.append("**Deliveries waiting on Discord**: {}/{}".format(self.ingress.pending, self.ingress.max_pending))
+        lines.append("**Dropped messages**: {}".format(self.ingress.dropped))
+
+        lines.append("")
+        lines.append("**Cached server configs**: {}/{}".format(
+            len(self.data_manager.data), self.data_manager.cache_size
+        ))
+
+        for line in line_splitter(lines, 2000):
+            await self.send_message(message.channel, line)
 
+    @command("unlinkall", permission=PERMISSION_MANAGE_SERVER)
+    async def command_unlink_all(self, data, data_string, message):
         if len(data) < 1:
             return await self.send_message(message.channel, "Usage: `unlink-all <channel ID>`")
 
@@ -1211,10 +1472,9 @@ class Client(discord.client.Client):
                 "Permission denied - you must have `Manage Server` on the server belonging to that channel."
             )
 
-        targets = self.data_manager.get_all_targets(channel).copy()
+        targets = set(self.data_manager.get_all_targets(channel))
 
-        if message.channel.id in targets:
-            targets.remove(message.channel.id)
+        targets.discard(int(message.channel.id))
 
         if not targets:
             return await self.send_message(message.channel, "This channel is not linked to any others.")
@@ -1245,8 +1505,88 @@ class Client(discord.client.Client):
 
     # region: Webhook management methods
 
+    async def get_relay_hook(self, channel_id):
+        hook = self.data_manager.get_webhook(channel_id)
+
+        if hook is None:
+            await self.resolve_relay_hook(channel_id)
+            hook = self.data_manager.get_webhook(channel_id)
+
+        return hook
+
+    async def resolve_relay_hook(self, channel_id):
+        # Concurrent lookups for the same channel share a request, so we never create two relay webhooks
+        task = self.pending_hooks.get(channel_id)
+
+        if task is None:
+            task = self.loop.create_task(self.ensure_relay_hook(channel_id))
+            task.add_done_callback(lambda _: self.pending_hooks.pop(channel_id, None))
+
+            self.pending_hooks[channel_id] = task
+
+        h = await asyncio.shield(task)
+
+        if h and self.data_manager.get_webhook(channel_id) is None:
+            self.data_manager.set_webhook(channel_id, h)
+            self.data_manager.save()
+
+        return h
+
+    async def warm_up_webhooks(self):
+        channels = deque(
+            channel_id for channel_id in self.data_manager.get_all_target_channels()
+            if self.data_manager.get_webhook(channel_id) is None
+        )
+
+        total = len(channels)
+
+        if not total:
+            return log.info("All webhooks are cached, no warm-up needed.")
+
+        log.info("Warming up webhooks for {} channels...".format(total))
+
+        started = time.monotonic()
+        step = max(total // 10, 1)
+        done = 0
+
+        async def worker():
+            nonlocal done
+
+            while channels:
+                await self.warm_up_webhook(channels.popleft())
+                done += 1
+
+                if done % step == 0 and done < total:
+                    log.info("Webhook warm-up: {}/{} channels done".format(done, total))
+
+        workers = max(min(self.config.get("warm_up_workers", 5), total), 1)
+        await asyncio.gather(*[worker() for _ in range(workers)])
+
+        log.info("Webhook warm-up finished: {} channels in {:.2f}s".format(total, time.monotonic() - started))
+
+    async def warm_up_webhook(self, channel_id):
+        try:
+            h = await self.resolve_relay_hook(channel_id)
+        except Exception:
+            # Could be temporary, so we leave the channel alone and let relaying deal with it
+            return log.exception("Unable to get webhook for channel: `{}`".format(channel_id))
+
+        if h is None:  # Doesn't exist
+            log.debug("Channel {} no longer exists.".format(channel_id))
+            self.data_manager.unlink_all(channel_id)
+            self.data_manager.save()
+        elif h is False:  # No permission
+            await self.send_message(
+                self.get_channel(channel_id),
+                "**Error**: I do not have permission to manage webhooks on this channel.\n\n"
+                "As I require this permission to function, I have entirely unlinked this channel. Please link "
+                "it again when this is fixed."
+            )
+            self.data_manager.unlink_all(channel_id)
+            self.data_manager.save()
+
     async def ensure_relay_hook(self, channel):
-        if isinstance(channel, str):
+        if isinstance(channel, (str, int)):
             channel = self.get_channel(channel)
 
         if not channel:
@@ -1347,34 +1687,13 @@ class Client(discord.client.Client):
         await self.http.request(r)
 
     async def execute_webhook(self, webhook_id, webhook_token, *, wait=False, content=None, username=None,
-                              avatar_url=None, tts=False, file=None, embeds=None) -> None:
-        r = Route("POST", "/webhooks/{webhook_id}/{webhook_token}".format(
-            webhook_id=webhook_id, webhook_token=webhook_token
-        ))
-
-        payload = {
-            "content": content,
-            "username": username,
-            "avatar_url": avatar_url,
-            "tts": tts,
-            "file": file,
-            "embeds": embeds
-        }
-
-        for key, value in payload.copy().items():
-            if value is None:
-                del payload[key]
-
-        found = False
-
-        for key in ["content", "file", "embeds"]:
-            if key in payload:
-                found = True
-
-        if not found:
-            raise KeyError("Must include at least one of `content`, `embeds` or `file`")
+                              avatar_url=None, tts=False, file=None, embeds=None) -> Dict:
+        payload = Payload.create(
+            content=content, username=username, avatar_url=avatar_url, tts=tts, file=file, embeds=embeds
+        )
 
-        await self.http.request(r, json=payload, params={"wait": str(wait).lower()})
+        # Queued per-webhook so that we can pace ourselves against the webhook's own rate limits
+        return await self.delivery.submit(webhook_id, webhook_token, payload, wait=wait)
 
     # endregion
 
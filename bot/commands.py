@@ -0,0 +1,79 @@
+# coding=utf-8
+import re
+
+from typing import Dict, Optional, Tuple
+
+__author__ = "Gareth Coles"
+
+PERMISSION_MANAGE_SERVER = "manage_server"  # `Manage Server` on the message's server, or the bot's owner
+PERMISSION_OWNER = "owner"  # The bot's owner only
+
+
+class Command:
+    __slots__ = ("name", "handler", "permission", "raw_args")
+
+    def __init__(self, name, handler, permission=None, raw_args=False):
+        self.name = name
+        self.handler = handler
+        self.permission = permission
+        self.raw_args = raw_args  # If set, the command only wants the argument string, so it isn't split with shlex
+
+
+def command(*aliases, permission=None, raw_args=False):
+    # Extra names for a `command_*` method, the permission it needs, and whether to skip shlex for its args
+    def inner(func):
+        func.command_aliases = aliases
+        func.command_permission = permission
+        func.command_raw_args = raw_args
+
+        return func
+
+    return inner
+
+
+def build_commands(obj) -> Dict[str, Command]:
+    # Underscored names can also be run with hyphens, eg. `unlink_all` or `unlink-all`
+    commands = {}
+
+    for attr in dir(type(obj)):
+        if not attr.startswith("command_"):
+            continue
+
+        handler = getattr(obj, attr)
+
+        if not callable(handler):
+            continue
+
+        cmd = Command(
+            attr[len("command_"):], handler,
+            permission=getattr(handler, "command_permission", None),
+            raw_args=getattr(handler, "command_raw_args", False)
+        )
+
+        for name in (cmd.name,) + getattr(handler, "command_aliases", ()):
+            commands[name] = cmd
+            commands[name.replace("_", "-")] = cmd
+
+    return commands
+
+
+def compile_trigger(control_chars, user_id):
+    # The server's control chars, or a mention of the bot with or without its nickname
+    triggers = (control_chars, "<@{}>".format(user_id), "<@!{}>".format(user_id))
+    return re.compile("|".join(re.escape(trigger) for trigger in triggers))
+
+
+def parse_command(trigger, content) -> Optional[Tuple[str, str]]:
+    # Only the trigger goes through the regex, so this stays linear whatever the message contains
+    match = trigger.match(content)
+
+    if match is None:
+        return None
+
+    text = content[match.end():].strip()
+
+    if not text:
+        return None
+
+    name, _, args = text.partition(" ")
+    return name, args
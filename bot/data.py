@@ -1,483 +1,977 @@
 # coding=utf-8
+import asyncio
+import functools
 import logging
-import os
-import re
 
-from discord import Channel
-from ruamel import yaml
-from typing import Dict, Any
+from collections import OrderedDict
+from discord import Channel, Server
+from typing import Dict, Any, List, Optional, Tuple
+
+from bot.export import read_export, write_export
+from bot.storage import Storage, SECTIONS, YAMLStorage
+from bot.trie import PrefixTrie
+from bot.utils import parse_flag
 
 __author__ = "Gareth Coles"
 
-DATA_REGEX = re.compile(r"[\d]+[\\/]?")
+EMPTY_ROUTES = frozenset()
 
 DEFAULT_CONFIG = {
-    "control_chars": ";"
+    "control_chars": ";",
+    "fire_and_forget": "no",
+    "coalesce_window": "0"
 }
 
+FLAG_KEYS = {"fire_and_forget"}  # Config keys that hold yes/no values
+INTEGER_KEYS = {"coalesce_window"}  # Config keys that hold whole numbers
+
 log = logging.getLogger("Data")
 
 
+def to_id(value) -> int:
+    # IDs are given to us as strings, but ints are smaller and quicker to compare
+    if isinstance(value, (Channel, Server)):
+        value = value.id
+
+    return int(value)
+
+
+class ServerConfig:
+    # Values are kept as strings, as they're given to the `config` command
+
+    __slots__ = tuple(sorted(DEFAULT_CONFIG))
+
+    def __init__(self, config=None):
+        for key, value in DEFAULT_CONFIG.items():
+            setattr(self, key, value)
+
+        if config:
+            for key, value in config.items():
+                if key in DEFAULT_CONFIG:  # Keys that have since been removed are dropped
+                    setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in DEFAULT_CONFIG
+
+    def __getitem__(self, key):
+        if key not in DEFAULT_CONFIG:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in DEFAULT_CONFIG:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in DEFAULT_CONFIG:
+            return default
+
+        return getattr(self, key)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def to_dict(self) -> Dict[str, str]:
+        return dict(self.items())
+
+
 class DataManager:
-    # data = {
-    #     server_id: {
-    #         config: {}
-    #     }
-    # }
+    # Channel and server IDs are all stored as ints - see `to_id()`, `load_section()` and `dump_section()`
 
-    data = {}
+    data = OrderedDict()  # {server_id: ServerConfig} - only the most recently used servers, see `get_server()`
 
-    channels = {}  # {channel_id: [channel_id]}
-    groups = {}  # {"group": [channel_id]}
-    relays = {}  # {channel_id: [channel_id]}
+    # Links and relays are replaced rather than modified, so that routes can share them - see `compile_routes()`
+    channels = {}  # {channel_id: frozenset(channel_id)}
+    groups = {}  # {"group": {channel_id}}
+    relays = {}  # {channel_id: frozenset(channel_id)}
     prefixes = {}  # {channel_id: {"prefix": channel_id}}
+    webhooks = {}  # {channel_id: {"id": webhook_id, "token": webhook_token}}
 
-    def __init__(self):
-        if not os.path.exists("data"):
-            os.mkdir("data")
+    channel_groups = {}  # {channel_id: {"group"}} - reverse index of `groups`
+    prefix_tries = {}  # {channel_id: PrefixTrie} - compiled from `prefixes`
+    routes = {}  # {channel_id: frozenset(channel_id)} - compiled from the above, see `compile_routes()`
+    routed_channels = set()  # {channel_id} - every channel with routes or prefixes, for skipping everything else
+
+    def __init__(self, loop=None, save_delay=5, storage: Storage = None, cache_size=1000):
+        if storage is None:
+            storage = YAMLStorage()
+
+        self.storage = storage
+
+        # Server configs are loaded when they're first needed, and we only keep `cache_size` of them around
+        self.cache_size = max(cache_size, 1)
+        self.evicting = {}  # {server_id: data} - evicted from the cache, but still being written out
+        self.eviction_futures = set()
+
+        # When we have a loop, saves are batched up and written after `save_delay` seconds
+        self.loop = loop
+        self.save_delay = save_delay
+        self.flush_handle = None
+        self.flush_task = None
+
+        self.dirty = set()  # Names of sections that need writing
+        self.dirty_servers = set()  # IDs of servers whose configs need writing
+
+        self.replaying = False
+        self.reloading = False  # Flushes are held back while this is set - see `reload_changed()`
+        self.importing = False  # Flushes and evictions are held back, and mutations deferred - see `import_file()`
+        self.deferred = []  # [(operation, args)] - mutations made during an import, applied on top of it afterwards
+        self.loaded = False
 
     # region Data management
 
     def load(self):
-        self.data = {}
+        self.replace_sections(self.storage.load())
+        self.loaded = True
 
-        if not os.path.exists("data/channels.yml"):
-            self.channels = {}
-        else:
-            with open("data/channels.yml", "r") as fh:
-                self.channels = yaml.safe_load(fh)
+        # Anything replayed stays marked as dirty, since the storage doesn't have it anywhere but its journal
+        self.replaying = True
 
-        if not os.path.exists("data/groups.yml"):
-            self.groups = {}
-        else:
-            with open("data/groups.yml", "r") as fh:
-                self.groups = yaml.safe_load(fh)
+        try:
+            for operation, args in self.storage.replay():
+                self.apply(operation, *args)
+        finally:
+            self.replaying = False
 
-        if not os.path.exists("data/relays.yml"):
-            self.relays = {}
-        else:
-            with open("data/relays.yml", "r") as fh:
-                self.relays = yaml.safe_load(fh)
+    def replace_sections(self, sections):
+        self.swap_in_sections(self.convert_sections(sections))
+
+    @classmethod
+    def convert_sections(cls, sections) -> Dict[str, dict]:
+        ids = {}
+        converted = {}
+
+        for section in SECTIONS:
+            # Popped so that each section's stored form can be freed as soon as it's been converted
+            converted[section] = cls.convert_section(section, sections.pop(section, None) or {}, ids)
+
+        return converted
+
+    def swap_in_sections(self, sections):
+        for section in SECTIONS:
+            setattr(self, section, sections[section])
+
+        self.data = OrderedDict()
+        self.evicting = {}
+
+        self.dirty.clear()
+        self.dirty_servers.clear()
+
+        self.rebuild_group_index()
+        self.rebuild_prefix_tries()
+        self.rebuild_routes()
+
+    def load_section(self, section, data, ids=None):
+        setattr(self, section, self.convert_section(section, data, ids))
+
+    @staticmethod
+    def convert_section(section, data, ids=None):
+        # Doesn't touch the DataManager, so it's safe to call on another thread
+        if ids is None:
+            ids = {}
 
-        if not os.path.exists("data/prefixes.yml"):
-            self.prefixes = {}
+        def to_int(value):
+            number = ids.get(value)
+
+            if number is None:
+                number = ids[value] = int(value)
+
+            return number
+
+        if section in ("channels", "relays"):
+            data = {
+                to_int(origin): frozenset(to_int(target) for target in targets)
+                for origin, targets in data.items() if targets
+            }
+        elif section == "groups":
+            data = {group: {to_int(channel) for channel in channels} for group, channels in data.items()}
+        elif section == "prefixes":
+            data = {
+                to_int(origin): {prefix: to_int(target) for prefix, target in prefixes.items()}
+                for origin, prefixes in data.items()
+            }
+        elif section == "webhooks":
+            data = {to_int(channel): {"id": hook["id"], "token": hook["token"]} for channel, hook in data.items()}
+
+        return data
+
+    def dump_section(self, section):
+        # Copied, so it can be serialized on another thread
+        data = getattr(self, section)
+
+        if section in ("channels", "relays"):
+            return {str(origin): [str(target) for target in sorted(targets)] for origin, targets in data.items()}
+        elif section == "groups":
+            return {group: [str(channel) for channel in sorted(channels)] for group, channels in data.items()}
+        elif section == "prefixes":
+            return {
+                str(origin): {prefix: str(target) for prefix, target in prefixes.items()}
+                for origin, prefixes in data.items()
+            }
+        elif section == "webhooks":
+            return {str(channel): hook.copy() for channel, hook in data.items()}
+
+        raise KeyError(section)
+
+    def apply(self, operation, *args):
+        if operation == "add_server":
+            server_id, config = to_id(args[0]), args[1]
+
+            if server_id not in self.data and not self.storage.has_server(server_id):
+                self.set_server_config(server_id, config)
+                self.dirty_servers.add(server_id)
         else:
-            with open("data/prefixes.yml", "r") as fh:
-                self.prefixes = yaml.safe_load(fh)
+            getattr(self, operation)(*args)
 
-        for fn in os.listdir("data/"):
-            if os.path.isdir("data/{}".format(fn)):
-                if DATA_REGEX.match(fn):
-                    if fn[-1] in "\\/":
-                        fn = fn[:-1]
+    def changed(self, section, operation, *args):
+        self.dirty.add(section)
+        self.record(operation, *args)
 
-                    try:
-                        self.load_server(fn)
-                    except Exception:
-                        log.exception("Failed to load server: {}".format(fn))
+    def record(self, operation, *args):
+        if self.replaying:
+            return
+
+        if self.importing:
+            # Recording now would wait on (or be wiped out by) the import, so this is done again once it's finished
+            self.deferred.append((operation, args))
+        else:
+            self.storage.record(operation, *args)
+
+    def mark_dirty(self, *sections):
+        self.dirty.update(sections)
 
     def save(self):
-        with open("data/channels.yml", "w") as fh:
-            yaml.safe_dump(self.channels, fh)
+        if self.loop is None:
+            return self.flush()
+
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.save_delay, self.start_flush)
+
+    def start_flush(self):
+        self.flush_handle = None
+
+        if self.reloading or self.importing or (self.flush_task is not None and not self.flush_task.done()):
+            # Still writing the last batch (or reading changed files), so try again later rather than racing it
+            return self.save()
+
+        self.flush_task = self.loop.create_task(self.flush_in_background(self.get_pending_writes()))
+
+    async def flush_in_background(self, previous=()):
+        writes = self.take_dirty()
+
+        if writes:
+            failed = await self.write_after(previous, writes)
+            self.mark_failed(writes, failed)
 
-        with open("data/groups.yml", "w") as fh:
-            yaml.safe_dump(self.groups, fh)
+    def get_pending_writes(self) -> list:
+        pending = [future for future in self.eviction_futures if not future.done()]
 
-        with open("data/relays.yml", "w") as fh:
-            yaml.safe_dump(self.relays, fh)
+        if self.flush_task is not None and not self.flush_task.done():
+            pending.append(self.flush_task)
 
-        with open("data/prefixes.yml", "w") as fh:
-            yaml.safe_dump(self.prefixes, fh)
+        return pending
 
-        for server_id, data in self.data.items():
-            self.save_server(server_id, data)
+    async def write_after(self, previous, writes):
+        # Earlier writes may have older copies of the same files, so they need to land first or they'd overwrite ours
+        if previous:
+            await asyncio.wait(previous)
+
+        return await self.loop.run_in_executor(None, self.storage.write, writes)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        writes = self.take_dirty()
+
+        if writes:
+            self.mark_failed(writes, self.storage.write(writes))
+
+    async def close(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            await self.flush_task
+
+        if self.eviction_futures:
+            await asyncio.wait(self.eviction_futures)
+
+        self.flush()
+        self.storage.close()
+
+    def take_dirty(self) -> List[Tuple[Any, Any]]:
+        dirty, self.dirty = self.dirty, set()
+        dirty_servers, self.dirty_servers = self.dirty_servers, set()
+
+        return self.storage.prepare(self, dirty, dirty_servers)
+
+    def mark_failed(self, writes, failed):
+        for key in failed:
+            if key in SECTIONS:
+                self.dirty.add(key)
+            else:
+                self.dirty_servers.add(key)
+
+        log.debug("Saved {} of {} data files".format(len(writes) - len(failed), len(writes)))
 
     def save_server(self, server_id, data=None):
-        if not data:
-            data = self.data[server_id]
+        server_id = to_id(server_id)
 
-        try:
-            if not os.path.exists("data/{}".format(server_id)):
-                self.add_server(server_id)
+        if data:
+            self.cache_server(server_id, data)
 
-            with open("data/{}/config.yml".format(server_id), "w") as config_fh:
-                yaml.safe_dump(data["config"], config_fh)
-        except Exception:
-            log.exception("Error saving server '{}'".format(server_id))
+        self.dirty_servers.add(server_id)
+        self.save()
 
     def load_server(self, server_id) -> bool:
-        if not os.path.exists("data/{}".format(server_id)):
+        config = self.storage.load_server(server_id)
+
+        if config is None:
             return False
 
-        log.debug("Loading server: {}".format(server_id))
+        self.set_server_config(server_id, config)
+        return True
 
-        with open("data/{}/config.yml".format(server_id), "r") as fh:
-            config = yaml.safe_load(fh)
+    def set_server_config(self, server_id, config):
+        # Any keys that were added since this server's config was written are filled in with their defaults
+        self.cache_server(server_id, ServerConfig(config))
 
-        self.data[server_id] = {
-            "config": config
-        }
+    def add_server(self, server_id) -> bool:
+        server_id = to_id(server_id)
+
+        if server_id in self.data or server_id in self.evicting or self.storage.has_server(server_id):
+            return False
+
+        self.cache_server(server_id, ServerConfig())
+        self.record("add_server", server_id, DEFAULT_CONFIG.copy())
+
+        self.save_server(server_id)
+        log.info("Added server: {}".format(server_id))
 
         return True
 
-    def add_server(self, server_id) -> bool:
-        if os.path.exists("data/{}".format(server_id)):
-            return False
+    def get_server(self, server_id) -> ServerConfig:
+        server_id = to_id(server_id)
+        data = self.data.get(server_id)
+
+        if data is not None:
+            self.data.move_to_end(server_id)
+            return data
+
+        data = self.evicting.get(server_id)
+
+        if data is not None:
+            # Still being written out, so the storage may not have caught up yet
+            self.cache_server(server_id, data)
+        elif not self.load_server(server_id):
+            self.add_server(server_id)
+
+        return self.data[server_id]
+
+    # endregion
+
+    # region Import and export
+
+    async def export(self, path) -> int:
+        sections = {section: self.dump_section(section) for section in SECTIONS}
+        return await self.run_in_executor(self.write_export, path, sections, self.dump_cached_servers())
+
+    def write_export(self, path, sections, cached_servers) -> int:
+        return write_export(path, sections, self.dump_servers(cached_servers))
+
+    def migrate(self, target: Storage):
+        sections = {section: self.dump_section(section) for section in SECTIONS}
+        target.replace_all(sections, self.dump_servers(self.dump_cached_servers()))
+
+    def dump_cached_servers(self) -> Dict[str, dict]:
+        # Cached configs may have changes that haven't been written yet, so they take priority over stored ones
+        servers = {str(server_id): config.to_dict() for server_id, config in self.evicting.items()}
+        servers.update((str(server_id), config.to_dict()) for server_id, config in self.data.items())
+
+        return servers
+
+    def dump_servers(self, cached_servers) -> Dict[str, dict]:
+        servers = {str(server_id): config for server_id, config in self.storage.load_servers().items()}
+        servers.update(cached_servers)
+
+        return servers
 
-        os.mkdir("data/{}".format(server_id))
+    async def import_file(self, path) -> int:
+        if self.importing:
+            raise RuntimeError("An import is already in progress")
 
-        with open("data/{}/config.yml".format(server_id), "w") as config_fh:
-            yaml.safe_dump(DEFAULT_CONFIG, config_fh)
+        self.importing = True
 
-        self.data[server_id] = {
-            "config": DEFAULT_CONFIG.copy()
+        try:
+            sections, servers = await self.run_in_executor(read_export, path)
+
+            # Converted up-front, so that nothing is stored unless all of it can be loaded again
+            converted = await self.run_in_executor(self.convert_sections, dict(sections))
+
+            # Anything that's still waiting to be written would otherwise end up on top of the import
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+
+            if self.flush_task is not None and not self.flush_task.done():
+                await asyncio.wait([self.flush_task])
+
+            if self.eviction_futures:
+                await asyncio.wait(self.eviction_futures)
+
+            await self.run_in_executor(self.storage.replace_all, sections, servers)
+        except Exception:
+            self.importing = False
+            deferred, self.deferred = self.deferred, []
+
+            # Nothing was replaced, so these have already been made to the data we still have
+            for operation, args in deferred:
+                self.storage.record(operation, *args)
+
+            self.save()
+            raise
+
+        count = sum(len(data) for data in sections.values()) + len(servers)
+
+        self.swap_in_sections(converted)
+        self.importing = False
+        self.apply_deferred()
+
+        log.info("Imported {} records from {}".format(count, path))
+        return count
+
+    def apply_deferred(self):
+        deferred, self.deferred = self.deferred, []
+
+        for operation, args in deferred:
+            if operation == "add_server":
+                self.add_server(args[0])  # Only if the import didn't include it
+            else:
+                getattr(self, operation)(*args)
+
+        if deferred:
+            log.info("Applied {} changes made during the import".format(len(deferred)))
+            self.save()
+
+    async def run_in_executor(self, func, *args):
+        if self.loop is None:
+            return func(*args)
+
+        return await self.loop.run_in_executor(None, func, *args)
+
+    # endregion
+
+    # region Hot reloading
+
+    async def reload_changed(self) -> set:
+        if self.importing:
+            return set()
+
+        self.reloading = True
+
+        try:
+            # A flush that's still writing would otherwise overwrite the changes we're about to read
+            if self.flush_task is not None and not self.flush_task.done():
+                await asyncio.wait([self.flush_task])
+
+            changed = self.storage.poll_changes()
+
+            if not changed:
+                return changed
+
+            sections = await self.loop.run_in_executor(None, self.read_sections, changed)
+
+            if self.importing:
+                return set()  # What we read may be from before the import, which replaces all of it anyway
+
+            self.swap_sections(sections)
+        finally:
+            self.reloading = False
+
+        return changed
+
+    def read_sections(self, sections) -> Dict[str, dict]:
+        ids = {}
+
+        return {
+            section: self.convert_section(section, self.storage.load_section(section), ids) for section in sections
         }
 
-        log.info("Added server: {}".format(server_id))
+    def swap_sections(self, sections):
+        # Nothing else runs on the loop while this does, so relaying never sees a mix of old and new data
+        affected = set()
 
-        return True
+        for section, data in sections.items():
+            if section in self.dirty:
+                log.warning("Discarding unsaved changes to {}, as it was changed on disk".format(section))
+                self.dirty.discard(section)
+
+            old = getattr(self, section)
+
+            if section in ("channels", "relays"):
+                affected.update(origin for origin in old.keys() | data.keys() if old.get(origin) != data.get(origin))
+            elif section == "groups":
+                for group in old.keys() | data.keys():
+                    if old.get(group) != data.get(group):
+                        affected.update(old.get(group, ()), data.get(group, ()))
+            elif section == "prefixes":
+                for origin in old.keys() | data.keys():
+                    if old.get(origin) != data.get(origin):
+                        self.prefix_tries.pop(origin, None)
+
+                        if data.get(origin):
+                            self.prefix_tries[origin] = PrefixTrie(data[origin])
+
+                        affected.add(origin)  # Only to keep `routed_channels` up to date
+
+            setattr(self, section, data)
+
+        if "groups" in sections:
+            self.rebuild_group_index()
+
+        self.update_routes(*affected)
+
+        log.debug("Swapped in reloaded data: {} ({} routes updated)".format(", ".join(sorted(sections)), len(affected)))
+
+    # endregion
+
+    # region Server cache
+
+    def cache_server(self, server_id, data):
+        self.data[server_id] = data
+        self.data.move_to_end(server_id)
+
+        while len(self.data) > self.cache_size:
+            self.evict_server(*self.data.popitem(last=False))
+
+    def evict_server(self, server_id, data):
+        dirty = server_id in self.dirty_servers
+        self.dirty_servers.discard(server_id)
+
+        if self.importing:
+            return  # Its config is about to be replaced, and any changes to it have been deferred
+
+        writes = self.storage.prepare_eviction(server_id, data.to_dict(), dirty)
+
+        if not writes:
+            return
+
+        self.evicting[server_id] = data
+
+        if self.loop is None:
+            return self.eviction_written(server_id, data, self.storage.write(writes))
+
+        future = self.loop.create_task(self.write_after(self.get_pending_writes(), writes))
+        future.add_done_callback(functools.partial(self.eviction_done, server_id, data))
+
+        self.eviction_futures.add(future)
+
+    def eviction_done(self, server_id, data, future):
+        self.eviction_futures.discard(future)
+
+        if future.cancelled():
+            failed = {server_id}
+        elif future.exception() is not None:
+            log.error("Error writing evicted server {}: {}".format(server_id, future.exception()))
+            failed = {server_id}
+        else:
+            failed = future.result()
+
+        self.eviction_written(server_id, data, failed)
+
+    def eviction_written(self, server_id, data, failed):
+        if self.evicting.get(server_id) is data:
+            del self.evicting[server_id]
+
+        if failed:
+            # Put it back in the cache so the next flush can try again
+            if server_id not in self.data:
+                self.data[server_id] = data
+
+            self.dirty_servers.add(server_id)
+            self.save()
+        else:
+            log.debug("Wrote back evicted server: {}".format(server_id))
 
     # endregion
 
     # region Convenience functions
 
-    def get_config(self, server) -> Dict[str, Any]:
-        return self.data[server.id]["config"]
+    def get_config(self, server) -> ServerConfig:
+        return self.get_server(server.id)
 
     def set_config(self, server, key, value):
-        self.data[server.id]["config"][key] = value
+        server = to_id(server)
 
-    def get_server_command_chars(self, server) -> str:
-        return self.data[server.id]["config"]["control_chars"]
+        self.get_server(server)[key] = value
+        self.dirty_servers.add(server)
+        self.record("set_config", server, key, value)
 
-    def get_all_targets(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
+    def get_config_flag(self, server, key) -> bool:
+        return parse_flag(self.get_server(server.id)[key])
 
-        linked_channels = set()
-
-        for channel in self.get_targets(origin):
-            linked_channels.add(channel)
+    def get_config_int(self, server, key) -> int:
+        return int(self.get_server(server.id)[key])
 
-        for channel in self.get_relays(origin):
-            linked_channels.add(channel)
+    def get_server_command_chars(self, server) -> str:
+        return self.get_server(server.id).control_chars
 
-        for channel in self.find_grouped_channels(origin):
-            linked_channels.add(channel)
+    def get_all_targets(self, origin) -> frozenset:
+        if isinstance(origin, Channel):  # Called for every message, so this avoids a call to `to_id()`
+            origin = origin.id
 
-        return linked_channels
+        return self.routes.get(int(origin), EMPTY_ROUTES)
 
     def unlink_all(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
+        origin = to_id(origin)
 
         self.remove_targets(origin)
         self.remove_relays(origin)
         self.ungroup_channel_entirely(origin)
         self.remove_all_prefixes(origin)
+        self.remove_webhook(origin)
+
+    def get_all_target_channels(self) -> set:
+        channels = set(self.channels.keys())
+
+        for targets in self.channels.values():
+            channels.update(targets)
+
+        for targets in self.relays.values():
+            channels.update(targets)
+
+        channels.update(self.channel_groups.keys())
+
+        for prefixes in self.prefixes.values():
+            channels.update(prefixes.values())
+
+        return channels
 
     # endregion
 
-    # region Two-way relaying
+    # region Routing table
 
-    def add_target(self, origin, target):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
+    def compile_routes(self, origin) -> frozenset:
+        sources = [self.channels.get(origin, EMPTY_ROUTES), self.relays.get(origin, EMPTY_ROUTES)]
+        sources.extend(self.groups[group] for group in self.channel_groups.get(origin, ()))
+        sources = [channels for channels in sources if channels]
 
-        if origin not in self.channels:
-            self.channels[origin] = []
+        if not sources:
+            return EMPTY_ROUTES
 
-        if target not in self.channels[origin]:
-            self.channels[origin].append(target)
+        if len(sources) == 1 and isinstance(sources[0], frozenset):
+            return sources[0]  # Most channels only have links or relays, so there's no need for a copy
 
-        if target not in self.channels:
-            self.channels[target] = []
+        return frozenset().union(*sources)
 
-        if origin not in self.channels[target]:
-            self.channels[target].append(origin)
+    def rebuild_routes(self):
+        origins = set(self.channels.keys())
+        origins.update(self.relays.keys())
+        origins.update(self.channel_groups.keys())
 
-        log.info("Channels linked: {} <-> {}".format(origin, target))
+        self.routes = {}
+        self.update_routes(*origins)
 
-    def has_target(self, origin, target):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
+        self.rebuild_routed_channels()
 
-        if origin not in self.channels:
-            return False
+    def update_routes(self, *origins):
+        for origin in origins:
+            targets = self.compile_routes(origin)
 
-        return target in self.channels[origin]
+            if targets:
+                self.routes[origin] = targets
+            elif origin in self.routes:
+                del self.routes[origin]
 
-    def get_targets(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
+            self.update_routed_channel(origin)
 
-        if origin not in self.channels:
-            return []
+    def rebuild_routed_channels(self):
+        self.routed_channels = self.routes.keys() | self.prefix_tries.keys()
 
-        return self.channels[origin]
+    def update_routed_channel(self, origin):
+        if origin in self.routes or origin in self.prefix_tries:
+            self.routed_channels.add(origin)
+        else:
+            self.routed_channels.discard(origin)
 
-    def remove_target(self, origin, target):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
+    # endregion
+
+    # region Webhooks
 
-        if origin in self.channels and target in self.channels[origin]:
-            self.channels[origin].remove(target)
+    def get_webhook(self, channel) -> Optional[Dict[str, str]]:
+        return self.webhooks.get(to_id(channel))
 
-            if not self.channels[origin]:
-                del self.channels[origin]
+    def set_webhook(self, channel, hook):
+        channel = to_id(channel)
 
-        if target in self.channels and origin in self.channels[target]:
-            self.channels[target].remove(origin)
+        if not hook:
+            return
 
-            if not self.channels[target]:
-                del self.channels[target]
+        # We only need enough to execute the webhook, not the rest of what Discord gives us
+        self.webhooks[channel] = {
+            "id": hook["id"],
+            "token": hook["token"]
+        }
+
+        self.changed("webhooks", "set_webhook", channel, self.webhooks[channel])
+
+    def remove_webhook(self, channel):
+        channel = to_id(channel)
+
+        if channel in self.webhooks:
+            del self.webhooks[channel]
+            self.changed("webhooks", "remove_webhook", channel)
+
+    # endregion
+
+    # region Two-way relaying
+
+    def add_target(self, origin, target):
+        origin, target = to_id(origin), to_id(target)
+
+        self.channels[origin] = self.channels.get(origin, EMPTY_ROUTES) | {target}
+        self.channels[target] = self.channels.get(target, EMPTY_ROUTES) | {origin}
+
+        self.update_routes(origin, target)
+        self.changed("channels", "add_target", origin, target)
+
+        log.info("Channels linked: {} <-> {}".format(origin, target))
+
+    def has_target(self, origin, target):
+        return to_id(target) in self.channels.get(to_id(origin), ())
+
+    def get_targets(self, origin):
+        return self.channels.get(to_id(origin), EMPTY_ROUTES)
+
+    def remove_target(self, origin, target):
+        origin, target = to_id(origin), to_id(target)
+
+        self.discard_target(origin, target)
+        self.discard_target(target, origin)
+
+        self.update_routes(origin, target)
+        self.changed("channels", "remove_target", origin, target)
 
     def remove_targets(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
+        origin = to_id(origin)
 
-        if origin in self.channels:
-            del self.channels[origin]
+        # Links always go both ways, so we only need to look at the channels this one is linked to
+        affected = self.channels.pop(origin, EMPTY_ROUTES)
 
-        for channel, targets in list(self.channels.items()):
-            if origin in targets:
-                self.channels[channel].remove(origin)
+        for target in affected:
+            self.discard_target(target, origin)
 
-                if not self.channels[channel]:
-                    del self.channels[channel]
+        self.update_routes(origin, *affected)
+        self.changed("channels", "remove_targets", origin)
+
+    def discard_target(self, origin, target):
+        targets = self.channels.get(origin, EMPTY_ROUTES) - {target}
+
+        if targets:
+            self.channels[origin] = targets
+        else:
+            self.channels.pop(origin, None)
 
     # endregion
 
     # region One-way relaying
 
     def add_relay(self, origin, target):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
+        origin, target = to_id(origin), to_id(target)
 
-        if origin not in self.relays:
-            self.relays[origin] = [target]
-        else:
-            self.relays[origin].append(target)
+        self.relays[origin] = self.relays.get(origin, EMPTY_ROUTES) | {target}
+
+        self.update_routes(origin)
+        self.changed("relays", "add_relay", origin, target)
 
         log.info("Channel relayed: {} -> {}".format(origin, target))
 
     def has_relay(self, origin, target):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
-
-        if origin not in self.relays:
-            return False
-        return target in self.relays[origin]
+        return to_id(target) in self.relays.get(to_id(origin), ())
 
     def get_relays(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
-
-        if origin in self.relays:
-            return self.relays[origin]
-
-        return []
+        return self.relays.get(to_id(origin), EMPTY_ROUTES)
 
     def remove_relay(self, origin, target):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
+        origin, target = to_id(origin), to_id(target)
 
-        if origin not in self.relays:
+        if target not in self.relays.get(origin, ()):
             return
 
-        if target not in self.relays[origin]:
-            return
+        targets = self.relays[origin] - {target}
 
-        self.relays[origin].remove(target)
+        if targets:
+            self.relays[origin] = targets
+        else:
+            del self.relays[origin]
+
+        self.update_routes(origin)
+        self.changed("relays", "remove_relay", origin, target)
 
     def remove_relays(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
+        origin = to_id(origin)
 
         if origin in self.relays:
             del self.relays[origin]
+            self.update_routes(origin)
+            self.changed("relays", "remove_relays", origin)
 
     # endregion
 
     # region Groups
 
+    def rebuild_group_index(self):
+        self.channel_groups = {}
+
+        for group, channels in self.groups.items():
+            for channel in channels:
+                self.channel_groups.setdefault(channel, set()).add(group)
+
     def group_channel(self, group, channel):
-        if isinstance(channel, Channel):
-            channel = channel.id
+        channel = to_id(channel)
 
-        if group not in self.groups:
-            self.groups[group] = [channel]
-        else:
-            self.groups[group].append(channel)
+        if self.is_grouped_channel(group, channel):
+            return
+
+        self.groups.setdefault(group, set()).add(channel)
+        self.channel_groups.setdefault(channel, set()).add(group)
+
+        self.update_routes(*self.groups[group])
+        self.changed("groups", "group_channel", group, channel)
 
         log.info("Channel grouped: {} -> {}".format(group, channel))
 
     def ungroup_channel(self, group, channel):
-        if isinstance(channel, Channel):
-            channel = channel.id
+        channel = to_id(channel)
 
-        if group not in self.groups:
+        if not self.is_grouped_channel(group, channel):
             return
 
-        if channel not in self.groups[group]:
-            return
+        self.groups[group].discard(channel)
+        self.channel_groups[channel].discard(group)
 
-        self.groups[group].remove(channel)
+        if not self.channel_groups[channel]:
+            del self.channel_groups[channel]
 
-    def is_grouped_channel(self, group, channel):
-        if isinstance(channel, Channel):
-            channel = channel.id
-
-        if group not in self.groups:
-            return False
+        self.update_routes(channel, *self.groups[group])
+        self.changed("groups", "ungroup_channel", group, channel)
 
-        return channel in self.groups[group]
+    def is_grouped_channel(self, group, channel):
+        return group in self.channel_groups.get(to_id(channel), ())
 
     def find_groups(self, channel):
-        if isinstance(channel, Channel):
-            channel = channel.id
-
-        groups = set()
-
-        for group, channels in self.groups.items():
-            if channel in channels:
-                groups.add(group)
-
-        return groups
+        return set(self.channel_groups.get(to_id(channel), ()))
 
     def find_grouped_channels(self, channel):
-        if isinstance(channel, Channel):
-            channel = channel.id
-
         linked_channels = set()
 
-        for group, channels in self.groups.items():
-            if channel in channels:
-                [linked_channels.add(x) for x in channels]
+        for group in self.channel_groups.get(to_id(channel), ()):
+            linked_channels.update(self.groups[group])
 
         return linked_channels
 
     def get_channels_for_group(self, group):
-        return self.groups.get(group, [])
+        return self.groups.get(group, EMPTY_ROUTES)
 
     def ungroup_channel_entirely(self, channel):
-        if isinstance(channel, Channel):
-            channel = channel.id
+        channel = to_id(channel)
+        affected = {channel}
 
-        for group, channels in self.groups.items():
-            if channel in channels:
-                channels.remove(channel)
+        for group in self.channel_groups.pop(channel, ()):
+            channels = self.groups[group]
+            channels.discard(channel)
+            affected.update(channels)
+
+        self.update_routes(*affected)
+        self.changed("groups", "ungroup_channel_entirely", channel)
 
     # endregion
 
     # region Prefix-based relaying
 
-    def set_prefix(self, origin, target, prefix):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
+    def rebuild_prefix_tries(self):
+        self.prefix_tries = {
+            origin: PrefixTrie(prefixes) for origin, prefixes in self.prefixes.items() if prefixes
+        }
 
-        prefix = prefix.lower()
+        self.rebuild_routed_channels()
 
-        if origin not in self.prefixes:
-            self.prefixes[origin] = {
-                prefix: target
-            }
+    def remove_trie_prefix(self, origin, prefix):
+        trie = self.prefix_tries.get(origin)
+
+        if trie is None or prefix not in trie:
             return
 
-        self.prefixes[origin][prefix] = target
+        del trie[prefix]
 
-    def remove_prefix(self, origin, prefix):
-        if isinstance(origin, Channel):
-            origin = origin.id
+        if not len(trie):
+            del self.prefix_tries[origin]
+            self.update_routed_channel(origin)
+
+    def match_prefix(self, origin, content) -> Optional[Tuple[str, int]]:
+        trie = self.prefix_tries.get(to_id(origin))
 
+        if trie is None:
+            return None
+
+        return trie.match(content)
+
+    def set_prefix(self, origin, target, prefix):
+        origin, target = to_id(origin), to_id(target)
         prefix = prefix.lower()
 
-        if origin not in self.prefixes:
-            return
+        self.prefixes.setdefault(origin, {})[prefix] = target
+
+        if origin not in self.prefix_tries:
+            self.prefix_tries[origin] = PrefixTrie()
+            self.routed_channels.add(origin)
+
+        self.prefix_tries[origin][prefix] = target
+        self.changed("prefixes", "set_prefix", origin, target, prefix)
+
+    def remove_prefix(self, origin, prefix):
+        origin = to_id(origin)
+        prefix = prefix.lower()
 
-        if prefix in self.prefixes[origin]:
+        if prefix in self.prefixes.get(origin, ()):
             del self.prefixes[origin][prefix]
+            self.remove_trie_prefix(origin, prefix)
+            self.changed("prefixes", "remove_prefix", origin, prefix)
 
     def remove_prefix_by_channel(self, origin, target):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
+        origin, target = to_id(origin), to_id(target)
 
-        if origin not in self.prefixes:
-            return
-
-        for prefix, channel in self.prefixes[origin].items():
+        for prefix, channel in self.prefixes.get(origin, {}).items():
             if channel == target:
                 del self.prefixes[origin][prefix]
+                self.remove_trie_prefix(origin, prefix)
+                self.changed("prefixes", "remove_prefix", origin, prefix)
                 return
 
     def remove_all_prefixes(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
+        origin = to_id(origin)
 
         if origin not in self.prefixes:
             return
 
-        self.prefixes[origin].clear()
+        del self.prefixes[origin]
+        self.prefix_tries.pop(origin, None)
+        self.update_routed_channel(origin)
+        self.changed("prefixes", "remove_all_prefixes", origin)
 
     def has_prefix(self, origin, prefix):
-        if isinstance(origin, Channel):
-            origin = origin.id
-
-        prefix = prefix.lower()
-
-        if origin not in self.prefixes:
-            return False
-
-        return prefix in self.prefixes[origin]
+        return prefix.lower() in self.prefixes.get(to_id(origin), ())
 
     def has_specific_prefix(self, origin, target, prefix):
-        if isinstance(origin, Channel):
-            origin = origin.id
-        if isinstance(target, Channel):
-            target = target.id
-
-        prefix = prefix.lower()
-
-        if origin not in self.prefixes:
-            return False
-
-        return self.prefixes[origin].get(prefix) == target
-
-    def get_prefixed_target(self, origin, prefix):
-        if isinstance(origin, Channel):
-            origin = origin.id
+        return self.prefixes.get(to_id(origin), {}).get(prefix.lower()) == to_id(target)
 
-        prefix = prefix.lower()
-
-        if origin not in self.prefixes:
-            return None
-
-        return self.prefixes[origin].get(prefix)
+    def get_prefixed_target(self, origin, prefix) -> Optional[int]:
+        return self.prefixes.get(to_id(origin), {}).get(prefix.lower())
 
     def get_prefixes(self, origin):
-        if isinstance(origin, Channel):
-            origin = origin.id
-
-        if origin not in self.prefixes:
-            return {}
-
-        return self.prefixes[origin]
+        return self.prefixes.get(to_id(origin), {})
 
     # endregion
 
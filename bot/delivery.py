@@ -0,0 +1,372 @@
+# coding=utf-8
+import asyncio
+import email.utils
+import json
+import logging
+import time
+
+from collections import deque
+from typing import Dict
+
+from discord.errors import HTTPException, Forbidden, NotFound
+from discord.http import Route
+
+__author__ = "Gareth Coles"
+
+WEBHOOK_URL = Route.BASE + "/webhooks/{webhook_id}/{webhook_token}"
+MAX_ATTEMPTS = 5
+MAX_CONTENT_LENGTH = 2000
+MAX_COALESCE_DELAY = 5  # Multiple of the coalescing window a burst may hold a message back for at most
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+log = logging.getLogger("Delivery")
+
+
+def is_stale_webhook_error(e) -> bool:
+    return isinstance(e, HTTPException) and getattr(e.response, "status", None) in (401, 404)
+
+
+class Payload:
+    # Encoded to JSON at most once, no matter how many webhooks it's sent to
+
+    def __init__(self, data):
+        self.data = data
+        self._body = None
+
+    @classmethod
+    def create(cls, *, content=None, username=None, avatar_url=None, tts=False, file=None, embeds=None):
+        data = {
+            "content": content,
+            "username": username,
+            "avatar_url": avatar_url,
+            "tts": tts,
+            "file": file,
+            "embeds": embeds
+        }
+
+        for key, value in data.copy().items():
+            if value is None:
+                del data[key]
+
+        found = False
+
+        for key in ["content", "file", "embeds"]:
+            if key in data:
+                found = True
+
+        if not found:
+            raise KeyError("Must include at least one of `content`, `embeds` or `file`")
+
+        return cls(data)
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            self._body = json.dumps(self.data, separators=(",", ":")).encode("utf-8")
+
+        return self._body
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class DeliveryJob:
+    def __init__(self, payload: Payload, wait, coalesce_key=None, ready_at=0.0):
+        self.payload = payload
+        self.wait = wait
+        self.futures = []
+
+        # Jobs with the same key may be merged together until `ready_at`, at which point they're sent
+        self.coalesce_key = coalesce_key
+        self.ready_at = ready_at
+        self.deadline = ready_at
+
+    @property
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def can_merge(self, payload: Payload, wait, coalesce_key) -> bool:
+        if coalesce_key is None or coalesce_key != self.coalesce_key or wait != self.wait:
+            return False
+
+        if self.done:
+            return False
+
+        for key in ("file", "embeds", "tts"):
+            if self.payload.get(key) or payload.get(key):
+                return False
+
+        if self.payload.get("username") != payload.get("username"):
+            return False
+
+        if self.payload.get("avatar_url") != payload.get("avatar_url"):
+            return False
+
+        if "content" not in self.payload or "content" not in payload:
+            return False
+
+        return len(self.payload["content"]) + len(payload["content"]) + 1 <= MAX_CONTENT_LENGTH
+
+    def merge(self, payload: Payload):
+        # Payloads are shared with other queues, so we never modify them in place
+        self.payload = Payload(
+            dict(self.payload.data, content="{}\n{}".format(self.payload["content"], payload["content"]))
+        )
+
+    def set_result(self, result):
+        for future in self.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def set_exception(self, e):
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(e)
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+
+class WebhookQueue:
+    def __init__(self, webhook_id, webhook_token):
+        self.webhook_id = webhook_id
+        self.webhook_token = webhook_token
+
+        self.jobs = deque()
+        self.event = asyncio.Event()
+        self.worker = None
+
+        # Rate-limit state, as reported by the last response for this webhook
+        self.remaining = None
+        self.reset_at = 0.0
+
+    @property
+    def url(self):
+        return WEBHOOK_URL.format(webhook_id=self.webhook_id, webhook_token=self.webhook_token)
+
+
+class DeliveryScheduler:
+    # One queue per webhook, each of which sleeps until its rate limit bucket resets instead of hitting a 429
+
+    def __init__(self, client, concurrency=10, idle_timeout=60):
+        self.client = client
+        self.loop = client.loop
+
+        self.idle_timeout = idle_timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        self.queues = {}  # type: Dict[str, WebhookQueue]
+        self.global_reset_at = 0.0
+
+    # region Public API
+
+    def submit(self, webhook_id, webhook_token, payload: Payload, wait=False, coalesce_key=None,
+               coalesce_window=0) -> asyncio.Future:
+        # Submissions with the same coalesce_key within coalesce_window seconds are merged, if they fit
+        queue = self.queues.get(webhook_id)
+
+        if queue is None:
+            queue = WebhookQueue(webhook_id, webhook_token)
+            self.queues[webhook_id] = queue
+        else:
+            queue.webhook_token = webhook_token
+
+        future = self.loop.create_future()
+        now = self.loop.time()
+
+        if coalesce_window > 0 and queue.jobs and queue.jobs[-1].can_merge(payload, wait, coalesce_key):
+            job = queue.jobs[-1]
+            job.merge(payload)
+            job.futures.append(future)
+            job.ready_at = min(now + coalesce_window, job.deadline)
+
+            return future
+
+        if coalesce_window > 0:
+            job = DeliveryJob(payload, wait, coalesce_key, now + coalesce_window)
+            job.deadline = now + coalesce_window * MAX_COALESCE_DELAY
+        else:
+            job = DeliveryJob(payload, wait)
+
+        job.futures.append(future)
+
+        queue.jobs.append(job)
+        queue.event.set()
+
+        if queue.worker is None or queue.worker.done():
+            queue.worker = self.loop.create_task(self.run_queue(queue))
+
+        return future
+
+    def depth(self, webhook_id) -> int:
+        queue = self.queues.get(webhook_id)
+
+        if queue is None:
+            return 0
+
+        return len(queue.jobs)
+
+    def depths(self) -> Dict[str, int]:
+        return {webhook_id: len(queue.jobs) for webhook_id, queue in self.queues.items() if queue.jobs}
+
+    @property
+    def total_depth(self) -> int:
+        return sum(len(queue.jobs) for queue in self.queues.values())
+
+    def close(self):
+        for queue in self.queues.values():
+            if queue.worker is not None and not queue.worker.done():
+                queue.worker.cancel()
+
+            for job in queue.jobs:
+                job.cancel()
+
+        self.queues.clear()
+
+    # endregion
+
+    # region Workers
+
+    async def run_queue(self, queue: WebhookQueue):
+        while True:
+            if not queue.jobs:
+                queue.event.clear()
+
+                try:
+                    await asyncio.wait_for(queue.event.wait(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if not queue.jobs:
+                        # Idle for long enough, so there's no point keeping the worker around
+                        if self.queues.get(queue.webhook_id) is queue:
+                            del self.queues[queue.webhook_id]
+
+                        return
+
+                continue
+
+            await self.wait_for_bucket(queue)
+
+            # Give the job at the front of the queue a chance to pick up the rest of its burst
+            delay = queue.jobs[0].ready_at - self.loop.time()
+
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = queue.jobs[0].ready_at - self.loop.time()
+
+            job = queue.jobs.popleft()
+
+            if job.done:  # Cancelled while it was waiting in the queue
+                continue
+
+            try:
+                result = await self.send(queue, job)
+            except asyncio.CancelledError:
+                job.cancel()
+                raise
+            except Exception as e:
+                job.set_exception(e)
+            else:
+                job.set_result(result)
+
+    async def wait_for_bucket(self, queue: WebhookQueue):
+        now = self.loop.time()
+        delay = self.global_reset_at - now
+
+        if queue.remaining == 0:
+            delay = max(delay, queue.reset_at - now)
+
+        if delay > 0:
+            log.debug("Webhook {} is rate-limited, waiting {:.2f}s".format(queue.webhook_id, delay))
+            await asyncio.sleep(delay)
+
+    async def send(self, queue: WebhookQueue, job: DeliveryJob):
+        params = {"wait": str(job.wait).lower()}
+
+        for attempt in range(MAX_ATTEMPTS):
+            async with self.semaphore:
+                async with self.client.http.session.post(
+                    queue.url, data=job.payload.body, headers=JSON_HEADERS, params=params
+                ) as response:
+                    self.update_bucket(queue, response)
+
+                    if 200 <= response.status < 300:
+                        if response.status == 204:
+                            return None
+
+                        return await response.json()
+
+                    data = await self.read_body(response)
+
+                    if response.status != 429:
+                        if response.status == 403:
+                            raise Forbidden(response, data)
+                        elif response.status == 404:
+                            raise NotFound(response, data)
+
+                        raise HTTPException(response, data)
+
+            retry_after = data.get("retry_after", 1000) / 1000.0 if isinstance(data, dict) else 1.0
+
+            if isinstance(data, dict) and data.get("global"):
+                log.warning("Hit the global rate limit, pausing all deliveries for {:.2f}s".format(retry_after))
+                self.global_reset_at = self.loop.time() + retry_after
+            else:
+                queue.remaining = 0
+                queue.reset_at = self.loop.time() + retry_after
+
+            log.debug("Webhook {} was rate-limited (attempt {}/{}), retrying in {:.2f}s".format(
+                queue.webhook_id, attempt + 1, MAX_ATTEMPTS, retry_after
+            ))
+
+            await self.wait_for_bucket(queue)
+
+        raise HTTPException(response, "Gave up after {} rate-limited attempts".format(MAX_ATTEMPTS))
+
+    # endregion
+
+    # region Helpers
+
+    def update_bucket(self, queue: WebhookQueue, response):
+        headers = response.headers
+        remaining = headers.get("X-RateLimit-Remaining")
+
+        if remaining is None:
+            return
+
+        try:
+            queue.remaining = int(remaining)
+
+            if "X-RateLimit-Reset-After" in headers:
+                reset_after = float(headers["X-RateLimit-Reset-After"])
+            else:
+                # Older API versions only give us an absolute timestamp, so correct for clock skew using `Date`
+                now = time.time()
+
+                if "Date" in headers:
+                    now = email.utils.parsedate_to_datetime(headers["Date"]).timestamp()
+
+                reset_after = float(headers["X-RateLimit-Reset"]) - now
+        except (KeyError, TypeError, ValueError):
+            log.debug("Unable to parse rate-limit headers for webhook {}".format(queue.webhook_id))
+            return
+
+        queue.reset_at = self.loop.time() + max(reset_after, 0)
+
+    @staticmethod
+    async def read_body(response):
+        if response.headers.get("Content-Type", "").startswith("application/json"):
+            return await response.json()
+
+        return await response.text()
+
+    # endregion
+
+    pass  # Makes the last region collapsible
@@ -0,0 +1,100 @@
+# coding=utf-8
+import gzip
+import json
+
+from typing import Dict, Tuple
+
+from bot.storage import SECTIONS
+
+__author__ = "Gareth Coles"
+
+EXPORT_FORMAT = "relay-export"
+EXPORT_VERSION = 1
+
+
+def write_export(path, sections, servers) -> int:
+    # JSON lines - a header, then one `[kind, key, value]` record per line, in the storage backends' format
+    count = 0
+
+    with gzip.open(path, "wt", encoding="utf-8") as fh:
+        fh.write(json.dumps({"format": EXPORT_FORMAT, "version": EXPORT_VERSION}) + "\n")
+
+        for section in SECTIONS:
+            for key, value in sections.get(section, {}).items():
+                fh.write(json.dumps([section, key, value], separators=(",", ":")) + "\n")
+                count += 1
+
+        for server_id, config in servers.items():
+            fh.write(json.dumps(["server", str(server_id), config], separators=(",", ":")) + "\n")
+            count += 1
+
+    return count
+
+
+def is_id(value) -> bool:
+    return isinstance(value, str) and value.isdigit()
+
+
+def is_valid_record(kind, key, value) -> bool:
+    if not isinstance(key, str):
+        return False
+
+    if kind == "groups":
+        return isinstance(value, list) and all(is_id(channel) for channel in value)
+
+    if not is_id(key):
+        return False
+
+    if kind in ("channels", "relays"):
+        return isinstance(value, list) and all(is_id(target) for target in value)
+    elif kind == "prefixes":
+        return isinstance(value, dict) and all(
+            isinstance(prefix, str) and is_id(target) for prefix, target in value.items()
+        )
+    elif kind == "webhooks":
+        return isinstance(value, dict) and isinstance(value.get("id"), str) and isinstance(value.get("token"), str)
+    elif kind == "server":
+        return isinstance(value, dict) and all(
+            isinstance(name, str) and isinstance(setting, (str, int, float, bool)) for name, setting in value.items()
+        )
+
+    return False
+
+
+def read_export(path) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+    sections = {section: {} for section in SECTIONS}
+    servers = {}
+
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        try:
+            header = json.loads(fh.readline())
+        except ValueError:
+            header = None
+
+        if not isinstance(header, dict) or header.get("format") != EXPORT_FORMAT:
+            raise ValueError("Not an export file: {}".format(path))
+
+        if header.get("version") != EXPORT_VERSION:
+            raise ValueError("Unsupported export version: {}".format(header.get("version")))
+
+        for number, line in enumerate(fh, start=2):
+            if not line.strip():
+                continue
+
+            try:
+                kind, key, value = json.loads(line)
+            except ValueError:
+                raise ValueError("Unreadable record on line {}".format(number))
+
+            if kind != "server" and kind not in sections:
+                raise ValueError("Unknown record type on line {}: {}".format(number, kind))
+
+            if not is_valid_record(kind, key, value):
+                raise ValueError("Malformed {} record on line {}: {}".format(kind, number, key))
+
+            if kind == "server":
+                servers[key] = value
+            else:
+                sections[kind][key] = value
+
+    return sections, servers
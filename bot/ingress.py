@@ -0,0 +1,166 @@
+# coding=utf-8
+import asyncio
+import logging
+
+from collections import deque, OrderedDict
+
+__author__ = "Gareth Coles"
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_DROP_NEWEST = "drop_newest"
+POLICY_FAIR = "fair"
+
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_FAIR)
+
+log = logging.getLogger("Ingress")
+
+
+class IngressQueue:
+    # Handlers should `track()` slow work instead of waiting for it - workers stop taking messages while max_pending
+    # tracked jobs are unfinished, so a backlog sheds messages instead of growing without limit
+
+    def __init__(self, handler, loop, size=1000, workers=10, policy=POLICY_FAIR, max_pending=5000):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy: {} (expected one of: {})".format(policy, ", ".join(POLICIES)))
+
+        self.handler = handler
+        self.loop = loop
+
+        self.size = max(size, 1)
+        self.worker_count = max(workers, 1)
+        self.policy = policy
+        self.max_pending = max(max_pending, 1)
+
+        # {origin: deque(item)} - origins are served round-robin, in this order. Without the fair policy,
+        # everything goes into a single queue under `None`
+        self.origins = OrderedDict()
+        self.event = asyncio.Event()
+        self.capacity = asyncio.Event()  # Set whenever there's room for more pending jobs
+        self.capacity.set()
+        self.workers = []
+        self.tracked = set()
+
+        self.queued = 0  # Waiting right now
+        self.active = 0  # Being handled right now
+        self.pending = 0  # Tracked jobs that haven't finished yet
+        self.dropped = 0  # Shed since we started
+
+    # region Public API
+
+    def submit(self, origin, item) -> bool:
+        if not self.workers:
+            self.start()
+
+        if self.policy != POLICY_FAIR:
+            origin = None
+
+        if self.queued >= self.size:
+            if self.policy == POLICY_DROP_NEWEST:
+                self.dropped += 1
+                log.debug("Queue is full, dropping the newest message")
+                return False
+
+            self.drop_oldest()
+
+        items = self.origins.get(origin)
+
+        if items is None:
+            items = deque()
+            self.origins[origin] = items
+
+        items.append(item)
+        self.queued += 1
+        self.event.set()
+
+        return True
+
+    def track(self, future):
+        self.pending += 1
+        self.tracked.add(future)
+
+        if self.pending >= self.max_pending:
+            self.capacity.clear()
+
+        future.add_done_callback(self.pending_done)
+        return future
+
+    def start(self):
+        self.workers = [self.loop.create_task(self.run_worker()) for _ in range(self.worker_count)]
+
+    def close(self) -> list:
+        # Returns everything that was cancelled, so it can be awaited
+        cancelled = [future for future in self.workers + list(self.tracked) if not future.done()]
+
+        for future in cancelled:
+            future.cancel()
+
+        self.workers = []
+        self.origins.clear()
+        self.queued = 0
+
+        return cancelled
+
+    # endregion
+
+    # region Workers
+
+    async def run_worker(self):
+        while True:
+            if self.pending >= self.max_pending:
+                await self.capacity.wait()
+                continue
+
+            if not self.queued:
+                self.event.clear()
+                await self.event.wait()
+                continue
+
+            item = self.pop()
+            self.active += 1
+
+            try:
+                await self.handler(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Error handling queued message")
+            finally:
+                self.active -= 1
+
+    def pending_done(self, future):
+        self.pending -= 1
+        self.tracked.discard(future)
+
+        if self.pending < self.max_pending:
+            self.capacity.set()
+
+    def pop(self):
+        origin, items = next(iter(self.origins.items()))
+        item = items.popleft()
+
+        if items:
+            self.origins.move_to_end(origin)  # Everybody else gets a turn first
+        else:
+            del self.origins[origin]
+
+        self.queued -= 1
+        return item
+
+    def drop_oldest(self):
+        # Only the fair policy has more than one origin; the busiest one is the one that gets shed from
+        origin = max(self.origins, key=lambda key: len(self.origins[key]))
+        items = self.origins[origin]
+
+        items.popleft()
+
+        if not items:
+            del self.origins[origin]
+
+        self.queued -= 1
+        self.dropped += 1
+
+        log.debug("Queue is full, dropping the oldest message from %s", origin)
+
+    # endregion
+
+    pass  # Makes the last region collapsible
@@ -0,0 +1,22 @@
+# coding=utf-8
+from bot.storage.base import Storage, SECTIONS
+from bot.storage.journal_storage import JournalStorage
+from bot.storage.snapshot_storage import SnapshotStorage
+from bot.storage.sqlite_storage import SQLiteStorage
+from bot.storage.yaml_storage import YAMLStorage
+
+__author__ = "Gareth Coles"
+
+BACKENDS = {
+    YAMLStorage.name: YAMLStorage,
+    JournalStorage.name: JournalStorage,
+    SnapshotStorage.name: SnapshotStorage,
+    SQLiteStorage.name: SQLiteStorage
+}
+
+
+def get_storage(name="yaml", **kwargs) -> Storage:
+    if name not in BACKENDS:
+        raise KeyError("Unknown storage backend: {} (expected one of: {})".format(name, ", ".join(sorted(BACKENDS))))
+
+    return BACKENDS[name](**kwargs)
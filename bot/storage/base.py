@@ -0,0 +1,59 @@
+# coding=utf-8
+from typing import Any, Dict, List, Optional, Tuple
+
+__author__ = "Gareth Coles"
+
+SECTIONS = ("channels", "groups", "relays", "prefixes", "webhooks")
+
+
+class Storage:
+    # Everything is kept in memory by the DataManager, so backends only load it at startup, then persist changes by
+    # recording each mutation, writing out whatever's dirty on flush, or both
+
+    name = None
+    watchable = False  # Whether `poll_changes()` can tell when the stored data has been changed by something else
+
+    def load(self) -> Dict[str, dict]:
+        raise NotImplementedError()
+
+    def load_section(self, section) -> dict:
+        return self.load()[section]
+
+    def poll_changes(self) -> set:
+        # Names of sections changed by something else since they were last loaded
+        return set()
+
+    def load_servers(self) -> Dict[str, dict]:
+        raise NotImplementedError()
+
+    def load_server(self, server_id) -> Optional[dict]:
+        raise NotImplementedError()
+
+    def has_server(self, server_id) -> bool:
+        raise NotImplementedError()
+
+    def replay(self):
+        # `(operation, args)` for recorded mutations that `load()` doesn't reflect
+        return []
+
+    def record(self, operation, *args):
+        # Called after every mutation, with the DataManager method's name and its normalized arguments
+        pass
+
+    def prepare(self, manager, sections, servers) -> List[Tuple[Any, Any]]:
+        # Called on the loop when flushing - returns `(key, data)` writes for `write()`, copying what they need
+        return []
+
+    def prepare_eviction(self, server_id, config, dirty) -> List[Tuple[Any, Any]]:
+        # Like `prepare()`, for a server config that's being dropped from the cache
+        return []
+
+    def write(self, writes) -> set:
+        # May be called on another thread - returns the keys that couldn't be written
+        return set()
+
+    def replace_all(self, sections, servers):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
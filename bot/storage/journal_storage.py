@@ -0,0 +1,196 @@
+# coding=utf-8
+import json
+import logging
+import os
+import re
+import threading
+
+from bot.storage.yaml_storage import YAMLStorage
+
+__author__ = "Gareth Coles"
+
+JOURNAL_REGEX = re.compile(r"^journal\.(\d+)\.log$")
+COMPACTION_KEY = "__journal__"
+SYNC_KEY = "__sync__"
+
+log = logging.getLogger("Storage")
+
+
+class JournalStorage(YAMLStorage):
+    # YAML snapshots plus an append-only journal of every mutation since the last snapshot, which is replayed at startup
+
+    name = "journal"
+    watchable = False  # Hand edits to the snapshot would be undone by replaying the journal at the next start
+
+    def __init__(self, base_dir="data", compact_size=1024 * 1024, fsync=True, server_shards=0):
+        super().__init__(base_dir, server_shards)
+
+        self.compact_size = compact_size
+        self.fsync = fsync
+
+        # Everything that's changed since the last snapshot, and so needs to go into the next one
+        self.pending_sections = set()
+        self.pending_servers = set()
+
+        segments = self.get_segments()
+
+        self.segment = segments[-1] if segments else 1
+        self.size = 0
+        self.fh = None
+        self.unsynced = False  # Whether anything's been recorded since the last fsync was started
+
+        # `replace_all()` rotates the journal on an executor thread, while mutations are recorded on the loop
+        self.lock = threading.Lock()
+
+        self.open_segment()
+
+    # region Segments
+
+    def get_segment_path(self, segment) -> str:
+        return os.path.join(self.base_dir, "journal.{}.log".format(segment))
+
+    def get_segments(self):
+        segments = []
+
+        for fn in os.listdir(self.base_dir):
+            match = JOURNAL_REGEX.match(fn)
+
+            if match:
+                segments.append(int(match.group(1)))
+
+        return sorted(segments)
+
+    def open_segment(self):
+        path = self.get_segment_path(self.segment)
+
+        self.fh = open(path, "a", encoding="utf-8")
+        self.size = os.path.getsize(path)
+
+    def rotate(self) -> int:
+        with self.lock:
+            self.fh.close()
+
+            previous = self.segment
+            self.segment += 1
+            self.open_segment()
+
+        return previous
+
+    # endregion
+
+    def replay(self):
+        for segment in self.get_segments():
+            with open(self.get_segment_path(segment), "r", encoding="utf-8") as fh:
+                for number, line in enumerate(fh, start=1):
+                    if not line.strip():
+                        continue
+
+                    try:
+                        operation = json.loads(line)
+                    except ValueError:
+                        # Most likely a write that was cut off by a crash, which can only ever be the last line
+                        log.warning("Ignoring unreadable journal entry: segment {}, line {}".format(segment, number))
+                        continue
+
+                    yield operation[0], operation[1:]
+
+    def record(self, operation, *args):
+        line = json.dumps([operation] + list(args), separators=(",", ":")) + "\n"
+
+        # This is called on the loop, so the fsync is left for the next flush to do in the background
+        with self.lock:
+            self.fh.write(line)
+            self.fh.flush()
+
+            self.size += len(line.encode("utf-8"))
+            self.unsynced = self.fsync
+
+    def prepare(self, manager, sections, servers):
+        self.pending_sections.update(sections)
+        self.pending_servers.update(servers)
+
+        writes = []
+
+        if self.unsynced:
+            # A duplicate of the descriptor stays valid even if the segment is rotated before it's synced
+            with self.lock:
+                writes.append((SYNC_KEY, os.dup(self.fh.fileno())))
+                self.unsynced = False
+
+        if self.size < self.compact_size:
+            return writes
+
+        log.info("Journal is {} bytes, compacting...".format(self.size))
+
+        # New mutations go to a fresh segment, so the old ones can be removed once the snapshot is safely written
+        compacted = self.rotate()
+
+        writes.extend(super().prepare(manager, self.pending_sections, self.pending_servers))
+        writes.append((COMPACTION_KEY, compacted))
+
+        self.pending_sections = set()
+        self.pending_servers = set()
+
+        return writes
+
+    def prepare_eviction(self, server_id, config, dirty):
+        if not dirty and server_id not in self.pending_servers:
+            return []
+
+        # Once this is written, the next snapshot doesn't need to include it
+        self.pending_servers.discard(server_id)
+        return [(server_id, config.copy())]
+
+    def write(self, writes):
+        compacted = None
+
+        for key, data in writes:
+            if key == COMPACTION_KEY:
+                compacted = data
+            elif key == SYNC_KEY:
+                self.sync(data)
+
+        failed = super().write([(key, data) for key, data in writes if key not in (COMPACTION_KEY, SYNC_KEY)])
+
+        if compacted is not None:
+            if failed:
+                # These will be marked dirty again, and the old segments get replayed if we don't make it that far
+                log.warning("Unable to write snapshot, keeping journal segments up to {}".format(compacted))
+            else:
+                for segment in self.get_segments():
+                    if segment <= compacted:
+                        os.remove(self.get_segment_path(segment))
+
+                log.info("Journal compacted")
+
+        return failed
+
+    def sync(self, fd):
+        try:
+            os.fsync(fd)
+        except OSError:
+            log.exception("Unable to sync journal")
+        finally:
+            os.close(fd)
+
+    def replace_all(self, sections, servers):
+        super().replace_all(sections, servers)
+
+        # The journal only ever describes changes on top of the snapshot we just replaced
+        previous = self.rotate()
+
+        for segment in self.get_segments():
+            if segment <= previous:
+                os.remove(self.get_segment_path(segment))
+
+        self.pending_sections.clear()
+        self.pending_servers.clear()
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+        self.pending_sections.clear()
+        self.pending_servers.clear()
@@ -0,0 +1,86 @@
+# coding=utf-8
+import logging
+import os
+import pickle
+import struct
+
+from ruamel import yaml
+
+from bot.storage.base import SECTIONS
+from bot.storage.yaml_storage import YAMLStorage
+
+__author__ = "Gareth Coles"
+
+SNAPSHOT_MAGIC = b"RLSNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = SNAPSHOT_MAGIC + struct.pack(">H", SNAPSHOT_VERSION)
+
+# Protocol 5 where it's available, otherwise 4 (Python 3.6 and 3.7)
+PICKLE_PROTOCOL = min(pickle.HIGHEST_PROTOCOL, 5)
+
+log = logging.getLogger("Storage")
+
+
+class SnapshotStorage(YAMLStorage):
+    # Sections are pickled, so only load them from a data directory you trust. A newer YAML file takes precedence, so
+    # the YAML files can still be edited by hand
+
+    name = "snapshot"
+
+    def get_path(self, key) -> str:
+        if key in SECTIONS:
+            return os.path.join(self.base_dir, "{}.snapshot".format(key))
+
+        return super().get_path(key)
+
+    def get_yaml_path(self, section) -> str:
+        return super().get_path(section)
+
+    def get_watch_path(self, section) -> str:
+        return self.get_yaml_path(section)  # Snapshots are only written by us, but the YAML may be edited by hand
+
+    def load_section(self, section):
+        path = self.get_path(section)
+        yaml_path = self.get_yaml_path(section)
+
+        self.remember_mtime(section)
+
+        if os.path.exists(path):
+            if os.path.exists(yaml_path) and os.path.getmtime(yaml_path) > os.path.getmtime(path):
+                log.info("{} is newer than its snapshot, loading it instead".format(yaml_path))
+            else:
+                try:
+                    return self.read_snapshot(path)
+                except Exception as e:
+                    log.warning("Unable to read snapshot {}, falling back to YAML: {}".format(path, e))
+
+        if not os.path.exists(yaml_path):
+            return {}
+
+        with open(yaml_path, "r") as fh:
+            data = yaml.safe_load(fh) or {}
+
+        # Bring the snapshot up to date now, so the next start doesn't have to parse the YAML again
+        self.write([(section, data)])
+
+        return data
+
+    def read_snapshot(self, path) -> dict:
+        with open(path, "rb") as fh:
+            header = fh.read(len(SNAPSHOT_HEADER))
+
+            if not header.startswith(SNAPSHOT_MAGIC):
+                raise ValueError("Not a snapshot file")
+
+            if header != SNAPSHOT_HEADER:
+                version = struct.unpack(">H", header[len(SNAPSHOT_MAGIC):])[0]
+                raise ValueError("Unsupported snapshot version: {}".format(version))
+
+            return pickle.load(fh)
+
+    def encode(self, key, data):
+        if key in SECTIONS:
+            return SNAPSHOT_HEADER + pickle.dumps(data, protocol=PICKLE_PROTOCOL)
+
+        return super().encode(key, data)
+
@@ -0,0 +1,279 @@
+# coding=utf-8
+import logging
+import os
+import sqlite3
+import threading
+
+from bot.storage.base import Storage, SECTIONS
+from bot.storage.yaml_storage import YAMLStorage
+
+__author__ = "Gareth Coles"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    channel TEXT NOT NULL,
+    target TEXT NOT NULL,
+    PRIMARY KEY (channel, target)
+);
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+
+CREATE TABLE IF NOT EXISTS relays (
+    channel TEXT NOT NULL,
+    target TEXT NOT NULL,
+    PRIMARY KEY (channel, target)
+);
+
+CREATE TABLE IF NOT EXISTS group_members (
+    group_name TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    PRIMARY KEY (group_name, channel)
+);
+CREATE INDEX IF NOT EXISTS group_members_channel ON group_members (channel);
+
+CREATE TABLE IF NOT EXISTS prefixes (
+    channel TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    target TEXT NOT NULL,
+    PRIMARY KEY (channel, prefix)
+);
+
+CREATE TABLE IF NOT EXISTS webhooks (
+    channel TEXT PRIMARY KEY,
+    webhook_id TEXT NOT NULL,
+    webhook_token TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS server_config (
+    server_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (server_id, key)
+);
+"""
+
+TABLES = ("links", "relays", "group_members", "prefixes", "webhooks", "server_config")
+
+log = logging.getLogger("Storage")
+
+
+class SQLiteStorage(Storage):
+    # Existing YAML data is imported if the database is empty when it's first loaded
+
+    name = "sqlite"
+
+    def __init__(self, path="data/data.sqlite", base_dir="data", server_shards=0):
+        self.path = path
+        self.base_dir = base_dir
+        self.server_shards = server_shards  # Only used to find existing YAML data to import
+
+        if not os.path.exists(base_dir):
+            os.mkdir(base_dir)
+
+        # Exports read from the connection on an executor thread, so access to it is serialised with a lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    # region Loading
+
+    def is_empty(self) -> bool:
+        for table in TABLES:
+            if self.connection.execute("SELECT 1 FROM {} LIMIT 1".format(table)).fetchone():
+                return False
+
+        return True
+
+    def load(self):
+        with self.lock:
+            return self.load_sections()
+
+    def load_sections(self):
+        if self.is_empty() and os.path.exists(os.path.join(self.base_dir, "channels.yml")):
+            log.info("Database is empty, importing existing YAML data...")
+
+            source = YAMLStorage(self.base_dir, self.server_shards)
+            self.replace_all(source.load(), source.load_servers())
+
+        sections = {section: {} for section in SECTIONS}
+        execute = self.connection.execute
+
+        for channel, target in execute("SELECT channel, target FROM links ORDER BY rowid"):
+            sections["channels"].setdefault(channel, []).append(target)
+
+        for channel, target in execute("SELECT channel, target FROM relays ORDER BY rowid"):
+            sections["relays"].setdefault(channel, []).append(target)
+
+        for group, channel in execute("SELECT group_name, channel FROM group_members ORDER BY rowid"):
+            sections["groups"].setdefault(group, []).append(channel)
+
+        for channel, prefix, target in execute("SELECT channel, prefix, target FROM prefixes ORDER BY rowid"):
+            sections["prefixes"].setdefault(channel, {})[prefix] = target
+
+        for channel, webhook_id, webhook_token in execute("SELECT channel, webhook_id, webhook_token FROM webhooks"):
+            sections["webhooks"][channel] = {"id": webhook_id, "token": webhook_token}
+
+        return sections
+
+    def load_servers(self):
+        servers = {}
+
+        with self.lock:
+            for server_id, key, value in self.connection.execute("SELECT server_id, key, value FROM server_config"):
+                servers.setdefault(server_id, {})[key] = value
+
+        return servers
+
+    def load_server(self, server_id):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, value FROM server_config WHERE server_id = ?", (str(server_id),)
+            ).fetchall()
+
+        if not rows:
+            return None
+
+        return dict(rows)
+
+    def has_server(self, server_id):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT 1 FROM server_config WHERE server_id = ? LIMIT 1", (str(server_id),)
+            ).fetchone() is not None
+
+    # endregion
+
+    # region Mutations
+
+    def record(self, operation, *args):
+        handler = getattr(self, "op_{}".format(operation), None)
+
+        if handler is None:
+            return log.warning("Unsupported operation for SQLite storage: {}".format(operation))
+
+        with self.lock, self.connection:
+            handler(*args)
+
+    def op_add_target(self, origin, target):
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO links (channel, target) VALUES (?, ?)", [(origin, target), (target, origin)]
+        )
+
+    def op_remove_target(self, origin, target):
+        self.connection.executemany(
+            "DELETE FROM links WHERE channel = ? AND target = ?", [(origin, target), (target, origin)]
+        )
+
+    def op_remove_targets(self, origin):
+        self.connection.execute("DELETE FROM links WHERE channel = ? OR target = ?", (origin, origin))
+
+    def op_add_relay(self, origin, target):
+        self.connection.execute("INSERT OR IGNORE INTO relays (channel, target) VALUES (?, ?)", (origin, target))
+
+    def op_remove_relay(self, origin, target):
+        self.connection.execute("DELETE FROM relays WHERE channel = ? AND target = ?", (origin, target))
+
+    def op_remove_relays(self, origin):
+        self.connection.execute("DELETE FROM relays WHERE channel = ?", (origin,))
+
+    def op_group_channel(self, group, channel):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO group_members (group_name, channel) VALUES (?, ?)", (group, channel)
+        )
+
+    def op_ungroup_channel(self, group, channel):
+        self.connection.execute("DELETE FROM group_members WHERE group_name = ? AND channel = ?", (group, channel))
+
+    def op_ungroup_channel_entirely(self, channel):
+        self.connection.execute("DELETE FROM group_members WHERE channel = ?", (channel,))
+
+    def op_set_prefix(self, origin, target, prefix):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO prefixes (channel, prefix, target) VALUES (?, ?, ?)", (origin, prefix, target)
+        )
+
+    def op_remove_prefix(self, origin, prefix):
+        self.connection.execute("DELETE FROM prefixes WHERE channel = ? AND prefix = ?", (origin, prefix))
+
+    def op_remove_all_prefixes(self, origin):
+        self.connection.execute("DELETE FROM prefixes WHERE channel = ?", (origin,))
+
+    def op_set_webhook(self, channel, hook):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO webhooks (channel, webhook_id, webhook_token) VALUES (?, ?, ?)",
+            (channel, hook["id"], hook["token"])
+        )
+
+    def op_remove_webhook(self, channel):
+        self.connection.execute("DELETE FROM webhooks WHERE channel = ?", (channel,))
+
+    def op_add_server(self, server_id, config):
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO server_config (server_id, key, value) VALUES (?, ?, ?)",
+            [(server_id, key, value) for key, value in config.items()]
+        )
+
+    def op_set_config(self, server_id, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO server_config (server_id, key, value) VALUES (?, ?, ?)", (server_id, key, value)
+        )
+
+    # endregion
+
+    def replace_all(self, sections, servers):
+        # This can take a while, so it gets a connection of its own - in WAL mode, the loop can carry on reading the
+        # old data from ours until it's committed
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        try:
+            with connection:
+                self.write_all(connection, sections, servers)
+        finally:
+            connection.close()
+
+    def write_all(self, connection, sections, servers):
+        execute = connection.executemany
+
+        for table in TABLES:
+            connection.execute("DELETE FROM {}".format(table))
+
+        execute(
+            "INSERT OR IGNORE INTO links (channel, target) VALUES (?, ?)",
+            [(channel, target) for channel, targets in sections.get("channels", {}).items() for target in targets]
+        )
+
+        execute(
+            "INSERT OR IGNORE INTO relays (channel, target) VALUES (?, ?)",
+            [(channel, target) for channel, targets in sections.get("relays", {}).items() for target in targets]
+        )
+
+        execute(
+            "INSERT OR IGNORE INTO group_members (group_name, channel) VALUES (?, ?)",
+            [(group, channel) for group, channels in sections.get("groups", {}).items() for channel in channels]
+        )
+
+        execute(
+            "INSERT OR REPLACE INTO prefixes (channel, prefix, target) VALUES (?, ?, ?)",
+            [
+                (channel, prefix, target)
+                for channel, prefixes in sections.get("prefixes", {}).items()
+                for prefix, target in prefixes.items()
+            ]
+        )
+
+        execute(
+            "INSERT OR REPLACE INTO webhooks (channel, webhook_id, webhook_token) VALUES (?, ?, ?)",
+            [(channel, hook["id"], hook["token"]) for channel, hook in sections.get("webhooks", {}).items()]
+        )
+
+        execute(
+            "INSERT OR REPLACE INTO server_config (server_id, key, value) VALUES (?, ?, ?)",
+            [(server_id, key, value) for server_id, config in servers.items() for key, value in config.items()]
+        )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,358 @@
+# coding=utf-8
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+
+from collections import OrderedDict
+from ruamel import yaml
+from typing import Optional
+
+from bot.storage.base import Storage, SECTIONS
+from bot.utils import write_atomically
+
+__author__ = "Gareth Coles"
+
+DATA_REGEX = re.compile(r"[\d]+[\\/]?")
+
+SHARD_CACHE_SIZE = 8  # Number of parsed shards to keep around for `load_server()`
+
+log = logging.getLogger("Storage")
+
+
+class YAMLStorage(Storage):
+    # With server_shards set, server configs are packed into data/servers/<n>.json instead of data/<id>/config.yml
+
+    name = "yaml"
+    watchable = True
+
+    def __init__(self, base_dir="data", server_shards=0):
+        self.base_dir = base_dir
+        self.server_shards = server_shards
+
+        self.mtimes = {}  # {section: mtime} - as of when we last loaded or wrote each section's file
+
+        # Shards are read, updated and written back as a whole, possibly from several executor threads at once
+        self.shard_lock = threading.Lock()
+
+        # Written to from executor threads, so these are only ever touched while holding `cache_lock`
+        self.shard_cache = OrderedDict()  # {shard: {server_id: config}}, least recently used first
+        self.shard_versions = {}  # {shard: int} - bumped whenever a shard is written
+        self.server_index = None  # {server_id} - every server in the shards, built the first time it's needed
+        self.cache_lock = threading.Lock()
+
+        if not os.path.exists(base_dir):
+            os.mkdir(base_dir)
+
+        if server_shards and not os.path.exists(self.get_shard_dir()):
+            os.mkdir(self.get_shard_dir())
+
+    def get_path(self, key) -> str:
+        if key in SECTIONS:
+            return os.path.join(self.base_dir, "{}.yml".format(key))
+
+        if self.server_shards:
+            return self.get_shard_path(self.get_shard(key))
+
+        return os.path.join(self.base_dir, str(key), "config.yml")
+
+    # region Change detection
+
+    def get_watch_path(self, section) -> str:
+        return self.get_path(section)
+
+    def get_mtime(self, section) -> Optional[float]:
+        try:
+            return os.stat(self.get_watch_path(section)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def remember_mtime(self, section):
+        self.mtimes[section] = self.get_mtime(section)
+
+    def poll_changes(self):
+        return {section for section in SECTIONS if self.get_mtime(section) != self.mtimes.get(section)}
+
+    # endregion
+
+    # region Shards
+
+    def get_shard_dir(self) -> str:
+        return os.path.join(self.base_dir, "servers")
+
+    def get_shard(self, server_id) -> int:
+        return int(server_id) % self.server_shards
+
+    def get_shard_path(self, shard) -> str:
+        return os.path.join(self.get_shard_dir(), "{}.json".format(shard))
+
+    def read_shard(self, shard) -> dict:
+        path = self.get_shard_path(shard)
+
+        if not os.path.exists(path):
+            return {}
+
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+
+    def get_shard_data(self, shard) -> dict:
+        # Cached shards are replaced rather than modified, so callers mustn't modify what's returned either
+        with self.cache_lock:
+            data = self.shard_cache.get(shard)
+            version = self.shard_versions.get(shard, 0)
+
+            if data is not None:
+                self.shard_cache.move_to_end(shard)
+                return data
+
+        data = self.read_shard(shard)
+
+        with self.cache_lock:
+            # If it was written while we were reading, what we read may already be out of date
+            if self.shard_versions.get(shard, 0) == version:
+                self.cache_shard(shard, data)
+
+        return data
+
+    def shard_written(self, shard, data):
+        with self.cache_lock:
+            self.shard_versions[shard] = self.shard_versions.get(shard, 0) + 1
+            self.cache_shard(shard, data)
+
+            if self.server_index is not None:
+                self.server_index.update(data)
+
+    def cache_shard(self, shard, data):
+        self.shard_cache[shard] = data
+        self.shard_cache.move_to_end(shard)
+
+        while len(self.shard_cache) > SHARD_CACHE_SIZE:
+            self.shard_cache.popitem(last=False)
+
+    def get_server_index(self) -> set:
+        with self.cache_lock:
+            if self.server_index is not None:
+                return self.server_index
+
+        # Only done once, but nothing can be written to the shards while it is, or the index could miss it
+        with self.shard_lock:
+            index = set()
+
+            for shard in range(self.server_shards):
+                index.update(self.read_shard(shard))
+
+            with self.cache_lock:
+                if self.server_index is None:
+                    self.server_index = index
+
+                return self.server_index
+
+    def write_shards(self, configs, replace=False) -> set:
+        # With `replace`, every shard is rewritten with only the given configs
+        by_shard = {shard: {} for shard in range(self.server_shards)} if replace else {}
+        failed = set()
+
+        for server_id, config in configs.items():
+            by_shard.setdefault(self.get_shard(server_id), {})[str(server_id)] = config
+
+        with self.shard_lock:
+            for shard, updates in by_shard.items():
+                path = self.get_shard_path(shard)
+
+                try:
+                    data = {} if replace else self.read_shard(shard)
+                    data.update(updates)
+
+                    write_atomically(path, json.dumps(data, separators=(",", ":"), sort_keys=True))
+                    self.shard_written(shard, data)
+                except Exception:
+                    log.exception("Error saving data file: {}".format(path))
+                    failed.update(updates.keys() or {path})
+
+            if replace:
+                with self.cache_lock:
+                    self.server_index = None if failed else {str(server_id) for server_id in configs}
+
+        return failed
+
+    def migrate_server_directories(self):
+        servers = {
+            server_id: config for server_id, config in self.load_server_directories().items() if server_id.isdigit()
+        }
+
+        if not servers:
+            return
+
+        log.info("Moving {} server configs into {} shards...".format(len(servers), self.server_shards))
+
+        with self.shard_lock:
+            # Anything that's already in a shard is newer than what's in the old directories
+            for shard in {self.get_shard(server_id) for server_id in servers}:
+                for server_id in self.read_shard(shard):
+                    servers.pop(server_id, None)
+
+        failed = self.write_shards(servers)
+
+        if failed:
+            raise IOError("Failed to move server configs into shards: {}".format(", ".join(sorted(failed))))
+
+        for server_id in servers:
+            shutil.rmtree(os.path.join(self.base_dir, server_id))
+
+        log.info("Server configs moved")
+
+    # endregion
+
+    def load(self):
+        if self.server_shards:
+            self.migrate_server_directories()
+
+        return {section: self.load_section(section) for section in SECTIONS}
+
+    def load_section(self, section) -> dict:
+        path = self.get_path(section)
+        self.remember_mtime(section)  # Before reading, so a change made while we read isn't missed
+
+        if not os.path.exists(path):
+            return {}
+
+        with open(path, "r") as fh:
+            return yaml.safe_load(fh) or {}
+
+    def load_servers(self):
+        if not self.server_shards:
+            return self.load_server_directories()
+
+        servers = {}
+
+        for shard in range(self.server_shards):
+            servers.update(self.read_shard(shard))
+
+        return servers
+
+    def get_server_directories(self):
+        directories = []
+
+        for fn in os.listdir(self.base_dir):
+            if os.path.isdir(os.path.join(self.base_dir, fn)):
+                if DATA_REGEX.match(fn):
+                    if fn[-1] in "\\/":
+                        fn = fn[:-1]
+
+                    directories.append(fn)
+
+        return directories
+
+    def load_server_directories(self):
+        servers = {}
+
+        for fn in self.get_server_directories():
+            path = os.path.join(self.base_dir, fn, "config.yml")
+
+            if not os.path.exists(path):
+                continue
+
+            try:
+                with open(path, "r") as fh:
+                    servers[fn] = yaml.safe_load(fh) or {}
+            except Exception:
+                log.exception("Failed to load server: {}".format(fn))
+
+        return servers
+
+    def load_server(self, server_id):
+        if self.server_shards:
+            if not self.has_server(server_id):
+                return None
+
+            config = self.get_shard_data(self.get_shard(server_id)).get(str(server_id))
+            return None if config is None else dict(config)
+
+        if not self.has_server(server_id):
+            return None
+
+        log.debug("Loading server: {}".format(server_id))
+
+        with open(self.get_path(server_id), "r") as fh:
+            return yaml.safe_load(fh) or {}
+
+    def has_server(self, server_id):
+        if self.server_shards:
+            return str(server_id) in self.get_server_index()
+
+        return os.path.exists(os.path.join(self.base_dir, str(server_id)))
+
+    def prepare(self, manager, sections, servers):
+        writes = []
+
+        # The copies are what make it safe to serialize the data on another thread while the loop carries on
+        for section in SECTIONS:
+            if section in sections:
+                writes.append((section, manager.dump_section(section)))
+
+        for server_id in servers:
+            if server_id in manager.data:
+                writes.append((server_id, manager.data[server_id].to_dict()))
+
+        return writes
+
+    def prepare_eviction(self, server_id, config, dirty):
+        if not dirty:
+            return []
+
+        return [(server_id, config.copy())]
+
+    def write(self, writes):
+        failed = set()
+        shard_writes = {}
+
+        for key, data in writes:
+            if self.server_shards and key not in SECTIONS:
+                shard_writes[key] = data
+                continue
+
+            path = self.get_path(key)
+
+            try:
+                directory = os.path.dirname(path)
+
+                if not os.path.exists(directory):
+                    os.mkdir(directory)
+
+                write_atomically(path, self.encode(key, data))
+
+                if key in SECTIONS and path == self.get_watch_path(key):
+                    self.remember_mtime(key)  # So we don't mistake our own write for someone else's
+            except Exception:
+                log.exception("Error saving data file: {}".format(path))
+                failed.add(key)
+
+        if shard_writes:
+            failed.update(self.write_shards(shard_writes))
+
+        return failed
+
+    def encode(self, key, data):
+        return yaml.safe_dump(data)
+
+    def replace_all(self, sections, servers):
+        writes = [(section, sections.get(section, {})) for section in SECTIONS]
+
+        if self.server_shards:
+            failed = self.write(writes) | self.write_shards(servers, replace=True)
+        else:
+            writes.extend(servers.items())
+            failed = self.write(writes)
+
+        if failed:
+            raise IOError("Failed to write: {}".format(", ".join(str(key) for key in sorted(failed, key=str))))
+
+        # Anything that wasn't in what we were given would otherwise still be loaded. With shards, that includes any
+        # directories that haven't been moved into them yet
+        keep = set() if self.server_shards else {str(server_id) for server_id in servers}
+
+        for server_id in self.get_server_directories():
+            if server_id.isdigit() and server_id not in keep:
+                shutil.rmtree(os.path.join(self.base_dir, server_id))
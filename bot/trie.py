@@ -0,0 +1,111 @@
+# coding=utf-8
+from typing import Any, Optional, Tuple
+
+__author__ = "Gareth Coles"
+
+_VALUE = None  # Key used to store a value on a node; never a valid character
+
+
+class PrefixTrie:
+    # Case-insensitive; matching only walks the first `max_length` characters of the text
+
+    def __init__(self, items=None):
+        self.root = {}
+        self.lengths = {}  # {length: count}, so we know how far we need to look
+
+        if items:
+            for prefix, value in items.items():
+                self[prefix] = value
+
+    @property
+    def max_length(self) -> int:
+        return max(self.lengths) if self.lengths else 0
+
+    def __len__(self):
+        return sum(self.lengths.values())
+
+    def __contains__(self, prefix):
+        node = self._find(prefix.lower())
+        return node is not None and _VALUE in node
+
+    def __setitem__(self, prefix, value):
+        prefix = prefix.lower()
+        node = self.root
+
+        for char in prefix:
+            node = node.setdefault(char, {})
+
+        if _VALUE not in node:
+            self.lengths[len(prefix)] = self.lengths.get(len(prefix), 0) + 1
+
+        node[_VALUE] = value
+
+    def __delitem__(self, prefix):
+        prefix = prefix.lower()
+        path = [self.root]
+
+        for char in prefix:
+            node = path[-1].get(char)
+
+            if node is None:
+                raise KeyError(prefix)
+
+            path.append(node)
+
+        if _VALUE not in path[-1]:
+            raise KeyError(prefix)
+
+        del path[-1][_VALUE]
+
+        self.lengths[len(prefix)] -= 1
+
+        if not self.lengths[len(prefix)]:
+            del self.lengths[len(prefix)]
+
+        # Prune any nodes that no longer lead anywhere
+        for i in range(len(prefix), 0, -1):
+            if path[i]:
+                break
+
+            del path[i - 1][prefix[i - 1]]
+
+    def get(self, prefix, default=None):
+        node = self._find(prefix.lower())
+
+        if node is None:
+            return default
+
+        return node.get(_VALUE, default)
+
+    def match(self, text) -> Optional[Tuple[str, Any]]:
+        text = text[:self.max_length].lower()
+        node = self.root
+        best, best_node = None, None
+
+        if _VALUE in node:
+            best, best_node = 0, node
+
+        for i, char in enumerate(text):
+            node = node.get(char)
+
+            if node is None:
+                break
+
+            if _VALUE in node:
+                best, best_node = i + 1, node
+
+        if best is None:
+            return None
+
+        return text[:best], best_node[_VALUE]
+
+    def _find(self, prefix):
+        node = self.root
+
+        for char in prefix:
+            node = node.get(char)
+
+            if node is None:
+                return None
+
+        return node
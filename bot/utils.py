@@ -1,4 +1,6 @@
 # coding=utf-8
+import os
+import tempfile
 
 __author__ = "Gareth Coles"
 
@@ -31,3 +33,53 @@ def line_splitter(lines, max_size, split_only=False):
                 finished_lines.append(current_line)
 
     return finished_lines
+
+
+def parse_flag(value) -> bool:
+    if isinstance(value, bool):
+        return value
+
+    value = str(value).strip().lower()
+
+    if value in ("yes", "y", "true", "on", "1"):
+        return True
+    elif value in ("no", "n", "false", "off", "0"):
+        return False
+
+    raise ValueError("Not a yes/no value: {}".format(value))
+
+
+def write_atomically(path, data):
+    # Readers (and crashes) only ever see either the old file or the complete new one
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+
+    try:
+        if isinstance(data, bytes):
+            fh = os.fdopen(fd, "wb")
+        else:
+            fh = os.fdopen(fd, "w", encoding="utf-8")
+
+        with fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise
+
+    try:  # Make sure the rename itself survives a crash, where the platform allows it
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)